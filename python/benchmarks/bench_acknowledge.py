@@ -0,0 +1,52 @@
+"""
+Counts the Redis round trips a worker makes to acknowledge a test and record
+its result, before and after folding the error report into acknowledge.lua.
+
+Usage: PYTHONPATH=. python benchmarks/bench_acknowledge.py [tests]
+"""
+from __future__ import print_function
+import sys
+from ciqueue import distributed
+from benchmarks import support
+
+ERROR_REPORT = b'x' * 2048
+
+
+def run(tests, folded):
+    client = support.redis_client(counting=True)
+    queue = distributed.Worker(support.fake_tests(tests), worker_id='1', redis=client,
+                               build_id='bench', timeout=0)
+    error_key = queue.key('error-reports')
+    reserved = []
+    for i, test in enumerate(queue):
+        reserved.append((i, test))
+        if len(reserved) == tests:
+            break
+
+    support.CountingConnection.round_trips = 0
+    with support.Timer() as timer:
+        for i, test in reserved:
+            error = ERROR_REPORT if i % 2 else ''
+            if folded:
+                queue.acknowledge(test, error=error, always_record=not error)
+            elif queue.acknowledge(test) or not error:
+                # What RedisReporter.record used to do after acknowledging.
+                if error:
+                    client.hset(error_key, test, error)
+                else:
+                    client.hdel(error_key, test)
+    return support.CountingConnection.round_trips, timer.elapsed
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for label, folded in (('acknowledge + hset/hdel', False), ('acknowledge with error', True)):
+        round_trips, elapsed = run(tests, folded)
+        support.report(label, [
+            ('round trips per test', '{:.2f}'.format(float(round_trips) / tests)),
+            ('time per test', '{:.3f}ms'.format(elapsed * 1000 / tests)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Measures the round trips of an idle worker waiting for the last test of the
+build, held by another worker, and how long it takes to pick it up once that
+worker requeues it.
+
+Usage: PYTHONPATH=. python benchmarks/bench_idle.py [seconds]
+"""
+from __future__ import print_function
+import sys
+import threading
+import time
+from ciqueue import distributed
+from benchmarks import support
+
+
+def main():
+    idle_time = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    tests = support.fake_tests(1)
+    client = support.redis_client(counting=True)
+    busy = distributed.Worker(tests, worker_id='1', redis=client, build_id='bench',
+                              timeout=60, max_requeues=1, requeue_tolerance=1)
+    busy._reserve()  # pylint: disable=protected-access
+
+    # Both workers share the client, but only the idle one talks to Redis until the requeue
+    support.CountingConnection.round_trips = 0
+    idle = distributed.Worker(tests, worker_id='2', redis=client, build_id='bench',
+                              timeout=60)
+    picked_up = []
+
+    def run():
+        for test in idle:
+            picked_up.append(time.time())
+            idle.acknowledge(test)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(idle_time)
+    round_trips = support.CountingConnection.round_trips
+    requeued_at = time.time()
+    busy.requeue(tests[0])
+    thread.join()
+
+    support.report('idle worker', [
+        ('round trips per second', '{:.1f}'.format(round_trips / idle_time)),
+        ('requeue to pick up', '{:.1f}ms'.format((picked_up[0] - requeued_at) * 1000)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Compares the Redis memory used by a finished build, and the bytes its worker
+sent while running the tests, with and without interned test ids, for long
+parametrized test names.
+
+Usage: PYTHONPATH=. python benchmarks/bench_intern_ids.py [tests]
+"""
+from __future__ import print_function
+import sys
+from ciqueue import distributed
+from benchmarks import support
+
+
+def build_memory(client):
+    return sum(client.memory_usage(key) or 0 for key in client.scan_iter('build:{bench}:*'))
+
+
+def run(names, intern_ids):
+    client = support.redis_client(counting=True)
+    queue = distributed.Worker(names, worker_id='1', redis=client, build_id='bench',
+                               timeout=0, intern_ids=intern_ids)
+    sent = support.CountingConnection.bytes_sent
+    for i, test in enumerate(queue):
+        queue.acknowledge(test, error='boom' if i % 10 == 0 else '')
+    return build_memory(client), support.CountingConnection.bytes_sent - sent
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    names = ['tests/integration/test_checkout.py::TestCheckout::test_payment[{}-visa-USD-en_US-'
+             'with_discount-with_gift_card-express_shipping]'.format(i) for i in range(tests)]
+
+    print('{} tests, {} byte names\n'.format(tests, len(names[0])))
+    for label, intern_ids in (('test names', False), ('interned ids', True)):
+        memory, sent = run(names, intern_ids)
+        support.report(label, [
+            ('build keys memory', '{:.1f}MB'.format(memory / 1024.0 / 1024)),
+            ('bytes sent while running', '{:.1f}MB'.format(sent / 1024.0 / 1024)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
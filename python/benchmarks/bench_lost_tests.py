@@ -0,0 +1,65 @@
+"""
+Measures how long the lost tests check of reserve.lua and release.lua block Redis on a large build:
+every simulated worker holds a batch of tests, half of which were already
+processed by another worker and are waiting to be cleaned out of the running set.
+
+Usage: PYTHONPATH=. python benchmarks/bench_lost_tests.py [tests] [workers] [tests per worker]
+"""
+from __future__ import print_function
+import functools
+import sys
+import time
+from ciqueue import distributed
+from benchmarks import support
+
+
+def script_stats(client):
+    stats = client.info('commandstats').get('cmdstat_evalsha', {})
+    return stats.get('calls', 0), stats.get('usec_per_call', 0.0)
+
+
+def reserve_lost(queue):
+    # A batch size of 0 only reserves lost tests
+    return queue._try_to_reserve_test(batch_size=0)  # pylint: disable=protected-access
+
+
+def measure(client, label, calls):
+    client.config_resetstat()
+    latencies = []
+    for call in calls:
+        with support.Timer() as timer:
+            call()
+        latencies.append(timer.elapsed)
+    count, usec_per_call = script_stats(client)
+    support.report(label, [
+        ('script calls', count),
+        ('server time per call', '{:.1f}us'.format(usec_per_call)),
+        ('slowest call', '{:.2f}ms'.format(max(latencies) * 1000)),
+    ])
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    client = support.redis_client()
+    names = support.fake_tests(tests)
+    queues = [distributed.Worker(names, worker_id=str(i), redis=client, build_id='bench',
+                                 timeout=60, options=distributed.Options(batch_size=batch_size))
+              for i in range(workers)]
+    for queue in queues:
+        queue._reserve()  # pylint: disable=protected-access
+        queue.timeout = 0.001
+
+    running = client.zrange(queues[0].key('running'), 0, -1)
+    client.sadd(queues[0].key('processed'), *running[:len(running) // 2])
+    time.sleep(0.01)
+
+    print('{} tests, {} workers, {} running\n'.format(tests, workers, len(running)))
+    measure(client, 'reserve (lost tests)', [functools.partial(reserve_lost, queue) for queue in queues])
+    measure(client, 'release', [queue.release for queue in queues])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Measures the time to encode and decode the error reports of failing tests, and
+their size, in the compact and pickle formats of ciqueue._pytest.reports.
+
+The failures come from a generated test file: assertion errors a few frames
+deep, with local variables and captured output, in setup, call and teardown.
+
+Usage: PYTHONPATH=. python benchmarks/bench_reports.py [repeat]
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+from ciqueue._pytest import reports
+from benchmarks import support
+
+TESTS = '''
+import pytest
+
+
+def helper(depth, payload):
+    if depth:
+        return helper(depth - 1, payload)
+    assert payload == list(range(len(payload) + 1))
+
+
+@pytest.fixture
+def broken_setup():
+    helper(10, list(range(50)))
+
+
+@pytest.fixture
+def broken_teardown():
+    yield
+    helper(10, list(range(50)))
+
+
+@pytest.mark.parametrize('depth', range(20))
+def test_call(depth):
+    print('captured output\\n' * 20)
+    helper(depth, list(range(100)))
+
+
+def test_setup(broken_setup):
+    pass
+
+
+def test_teardown(broken_teardown):
+    pass
+'''
+
+
+class Measure(object):
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.rows = {}
+        self.tests = []
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        report = outcome.get_result()
+        if not hasattr(item, 'bench_reports'):
+            item.bench_reports = ({}, {})
+        if call.excinfo:
+            item.bench_reports[0][call.when] = call.__dict__.copy()
+        if report.failed:
+            item.bench_reports[1][call.when] = report
+        if call.when == 'teardown' and item.bench_reports[0]:
+            self.tests.append(item.bench_reports)
+
+    def pytest_sessionfinish(self, session):
+        config = session.config
+        formats = (
+            ('pickle', lambda test: reports.encode_pickle(test[0]), reports.decode_pickle),
+            ('compact', lambda test: reports.encode(config, test[1]),
+             lambda payload: reports.decode(config, payload)),
+        )
+        for label, encode, decode in formats:
+            with support.Timer() as encoding:
+                for _ in range(self.repeat):
+                    payloads = [encode(test) for test in self.tests]
+            with support.Timer() as decoding:
+                for _ in range(self.repeat):
+                    for payload in payloads:
+                        decode(payload)
+            count = len(self.tests) * self.repeat
+            self.rows[label] = [
+                ('encode per test', '{:.2f}ms'.format(encoding.elapsed * 1000 / count)),
+                ('decode per test', '{:.2f}ms'.format(decoding.elapsed * 1000 / count)),
+                ('bytes per test', '{:.0f}'.format(sum(len(p) for p in payloads) / float(len(payloads)))),
+            ]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'test_failures.py')
+        with open(path, 'w') as test_file:
+            test_file.write(TESTS)
+        measure = Measure(repeat)
+        pytest.main(['-q', '-p', 'no:cacheprovider', path], plugins=[measure])
+    finally:
+        shutil.rmtree(directory)
+
+    print('\n{} failing tests\n'.format(len(measure.tests)))
+    for label, rows in sorted(measure.rows.items()):
+        support.report(label, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compares requeueing into the deferred sorted set with the LINSERT based
+insertion the scripts fall back to when the deferred keys aren't passed
+(which is what the Ruby client does).
+
+Usage: PYTHONPATH=. python benchmarks/bench_requeue.py [queue size] [requeues]
+"""
+from __future__ import print_function
+import sys
+from ciqueue import distributed
+from benchmarks import support
+
+
+def run(tests, requeues, deferred):
+    client = support.redis_client()
+    queue = distributed.Worker(support.fake_tests(tests), worker_id='1', redis=client,
+                               build_id='bench', timeout=0, max_requeues=1, requeue_tolerance=1)
+    keys = [
+        queue.key('processed'),
+        queue.key('requeues-count'),
+        queue.key('queue'),
+        queue.key('running'),
+        queue.key('worker', queue.worker_id, 'queue'),
+        queue.key('owners'),
+        queue.key('error-reports'),
+        queue.key('requeued-by'),
+        queue.key('leases'),
+    ]
+    if deferred:
+        keys += [queue.key('deferred-queue'), queue.key('queue-pops')]
+
+    reserved = []
+    for _ in range(requeues):
+        test = queue._reserve()  # pylint: disable=protected-access
+        reserved.append((test, queue._leases[test]))  # pylint: disable=protected-access
+
+    client.config_resetstat()
+    with support.Timer() as timer:
+        for test, lease in reserved:
+            queue._eval_script('requeue', keys=keys,  # pylint: disable=protected-access
+                               args=[1, queue.global_max_requeues, test, 42, 0, lease])
+    usec_per_call = client.info('commandstats')['cmdstat_evalsha']['usec_per_call']
+    return usec_per_call, timer.elapsed
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    requeues = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    print('{} queued tests, {} requeues\n'.format(tests, requeues))
+    for label, deferred in (('LINSERT', False), ('deferred sorted set', True)):
+        usec_per_call, elapsed = run(tests, requeues, deferred)
+        support.report(label, [
+            ('server time per requeue', '{:.1f}us'.format(usec_per_call)),
+            ('time per requeue', '{:.3f}ms'.format(elapsed * 1000 / requeues)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
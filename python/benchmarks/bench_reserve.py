@@ -0,0 +1,81 @@
+"""
+Measures the latency and round trips of reserving a test with `timeout` set, when
+nothing is lost: reserve_lost.lua then reserve.lua, as workers used to, against
+reserve.lua alone, which checks for lost tests first. A peer holds a batch of
+running tests so that the lost tests check has something to look at.
+
+Usage: PYTHONPATH=. python benchmarks/bench_reserve.py [tests] [peer batch size]
+"""
+from __future__ import print_function
+import sys
+import time
+from ciqueue import distributed
+from benchmarks import support
+
+
+def reserve_lost(worker):
+    """reserve_lost.lua, which only the Ruby client calls anymore."""
+    return worker._eval_script(  # pylint: disable=protected-access
+        'reserve_lost',
+        keys=[worker.key(name) for name in ('running', 'processed')] +
+        [worker.key('worker', worker.worker_id, 'queue')] +
+        [worker.key(name) for name in ('owners', 'leases', 'lease-counter', 'timeout-offsets')],
+        args=[time.time(), worker.timeout],
+    )
+
+
+def reserve_in_two_calls(worker):
+    lost = reserve_lost(worker)
+    if lost:
+        return lost
+    timeout, worker.timeout = worker.timeout, 0
+    try:
+        return worker._try_to_reserve_test()  # pylint: disable=protected-access
+    finally:
+        worker.timeout = timeout
+
+
+def reserve_in_one_call(worker):
+    # Without the number of reclaimed tests that starts the reply
+    reserved = worker._try_to_reserve_test()  # pylint: disable=protected-access
+    return reserved and reserved[1:]
+
+
+def measure(label, build_id, reserve, tests, batch_size):
+    client = support.redis_client(counting=True)
+    peer = distributed.Worker(tests, worker_id='peer', redis=client, build_id=build_id,
+                              timeout=600, options=distributed.Options(batch_size=batch_size))
+    peer._reserve()  # pylint: disable=protected-access
+    worker = distributed.Worker(tests, worker_id='bench', redis=client, build_id=build_id, timeout=600)
+
+    latencies = []
+    round_trips = 0
+    while True:
+        support.CountingConnection.round_trips = 0
+        with support.Timer() as timer:
+            reserved = reserve(worker)
+        if not reserved:
+            break
+        round_trips += support.CountingConnection.round_trips
+        latencies.append(timer.elapsed)
+        worker.acknowledge(reserved[0].decode())
+
+    latencies.sort()
+    support.report(label, [
+        ('reservations', len(latencies)),
+        ('round trips per reservation', '{:.2f}'.format(round_trips / float(len(latencies)))),
+        ('mean latency', '{:.1f}us'.format(sum(latencies) * 1e6 / len(latencies))),
+        ('median latency', '{:.1f}us'.format(latencies[len(latencies) // 2] * 1e6)),
+    ])
+
+
+def main():
+    tests = support.fake_tests(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    measure('reserve_lost.lua then reserve.lua', 'two-calls', reserve_in_two_calls, tests, batch_size)
+    measure('reserve.lua with a timeout', 'one-call', reserve_in_one_call, tests, batch_size)
+
+
+if __name__ == '__main__':
+    main()
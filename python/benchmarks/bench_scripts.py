@@ -0,0 +1,51 @@
+"""
+Measures the round trips of the first reserve and acknowledge of freshly started workers (a new
+connection pool each, like separate processes), and of the heartbeat and
+write-behind pipelines of a running one.
+
+Usage: PYTHONPATH=. python benchmarks/bench_scripts.py [workers]
+"""
+from __future__ import print_function
+import sys
+import redis
+from ciqueue import distributed
+from benchmarks import support
+
+
+def new_client():
+    return redis.StrictRedis(connection_pool=redis.ConnectionPool(
+        host=support.redis_client().connection_pool.connection_kwargs['host'],
+        connection_class=support.CountingConnection))
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    tests = support.fake_tests(workers * 2)
+    # A fresh server, without any script loaded
+    support.redis_client().script_flush()
+
+    support.CountingConnection.round_trips = 0
+    with support.Timer() as cold_start:
+        for worker_id in range(workers):
+            worker = distributed.Worker(tests, worker_id=str(worker_id), redis=new_client(), build_id='bench',
+                                        timeout=60, options=distributed.Options(write_behind=10))
+            worker.acknowledge(worker._reserve())  # pylint: disable=protected-access
+    cold_start_round_trips = support.CountingConnection.round_trips
+
+    support.CountingConnection.round_trips = 0
+    for test in worker:
+        worker.heartbeat()
+        worker.acknowledge(test, always_record=True)
+        worker.flush()
+    pipelines = len(tests) - workers
+
+    support.report('{} workers starting'.format(workers), [
+        ('round trips to the first acknowledge', '{:.1f} per worker'.format(cold_start_round_trips / float(workers))),
+        ('time to the first acknowledge', '{:.1f}ms per worker'.format(cold_start.elapsed * 1000 / workers)),
+        ('round trips per heartbeat and flush', '{:.1f}'.format(
+            support.CountingConnection.round_trips / float(pipelines))),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""
+Measures how the leader seeds the queue of a large suite: the time it takes,
+the round trips, and the largest write sent to Redis at once.
+
+Usage: PYTHONPATH=. python benchmarks/bench_seed.py [tests]
+"""
+from __future__ import print_function
+import sys
+from ciqueue import distributed
+from benchmarks import support
+
+
+def main():
+    tests = support.fake_tests(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+    client = support.redis_client(counting=True)
+    support.CountingConnection.round_trips = 0
+    with support.Timer() as timer:
+        distributed.Worker(tests, worker_id='1', redis=client, build_id='bench', timeout=0)
+
+    support.report('{} tests'.format(len(tests)), [
+        ('seeding time', '{:.0f}ms'.format(timer.elapsed * 1000)),
+        ('round trips', support.CountingConnection.round_trips),
+        ('largest write', '{:.1f}KB'.format(support.CountingConnection.largest_send / 1024.0)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
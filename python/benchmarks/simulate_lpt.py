@@ -0,0 +1,59 @@
+"""
+Replays test durations on simulated workers popping from the queue, and compares
+the build makespan when the queue is seeded in collection order and longest first.
+
+Without a key, it uses generated durations: mostly fast tests with a few slow
+ones, the slowest at the end of the collection. With a key, it reads the
+durations recorded by the workers in that hash (the `durations_key` option),
+the database isn't flushed in that case.
+
+Usage: PYTHONPATH=. python benchmarks/simulate_lpt.py [workers] [durations_key]
+"""
+from __future__ import print_function
+import heapq
+import os
+import random
+import sys
+import redis
+from ciqueue import durations
+from benchmarks import support
+
+
+def makespan(queue, estimates, workers):
+    """Every worker pops the next test as soon as it's done with the previous one."""
+    free_at = [0.0] * workers
+    for test in queue:
+        heapq.heappush(free_at, heapq.heappop(free_at) + estimates[test])
+    return max(free_at)
+
+
+def generated_durations(count=2000):
+    rand = random.Random(42)
+    tests = support.fake_tests(count)
+    return dict((test, rand.lognormvariate(-1, 1) if i < count * 0.98 else rand.uniform(30, 120))
+                for i, test in enumerate(tests)), tests
+
+
+def recorded_durations(key):
+    client = redis.StrictRedis(host=os.getenv('REDIS_HOST', 'localhost'))
+    tests = sorted(field.decode() for field in client.hkeys(key))
+    return durations.Durations(client, key).estimates(tests), tests
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if len(sys.argv) > 2:
+        estimates, tests = recorded_durations(sys.argv[2])
+    else:
+        estimates, tests = generated_durations()
+
+    total = sum(estimates.values())
+    longest_first = sorted(tests, key=estimates.get, reverse=True)
+    print('{} tests, {} workers, {:.0f}s of tests, {:.1f}s at best\n'.format(
+        len(tests), workers, total, max(total / workers, max(estimates.values()))))
+    for label, queue in (('collection order', tests), ('longest first', longest_first)):
+        support.report(label, [('makespan', '{:.1f}s'.format(makespan(queue, estimates, workers)))])
+
+
+if __name__ == '__main__':
+    main()
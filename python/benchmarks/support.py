@@ -0,0 +1,53 @@
+"""
+Helpers shared by the benchmarks, they expect a disposable Redis server
+(REDIS_HOST, defaults to localhost) since they flush the database.
+"""
+import os
+import time
+import redis
+
+
+class CountingConnection(redis.Connection):
+    """Counts the commands (or pipelines) written to the socket, i.e. round trips."""
+    round_trips = 0
+    bytes_sent = 0
+    largest_send = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        if isinstance(command, (bytes, str)):
+            command = [command]
+        size = sum(len(chunk) for chunk in command)
+        CountingConnection.bytes_sent += size
+        CountingConnection.largest_send = max(CountingConnection.largest_send, size)
+        return super(CountingConnection, self).send_packed_command(command, check_health)
+
+
+def redis_client(counting=False):
+    kwargs = {'host': os.getenv('REDIS_HOST', 'localhost')}
+    if counting:
+        kwargs['connection_class'] = CountingConnection
+    client = redis.StrictRedis(connection_pool=redis.ConnectionPool(**kwargs))
+    client.flushdb()
+    return client
+
+
+def fake_tests(count):
+    return ['tests/test_bench.py::TestBench::test_{}'.format(i) for i in range(count)]
+
+
+class Timer(object):
+
+    def __enter__(self):
+        self.start = time.time()
+        self.elapsed = None
+        return self
+
+    def __exit__(self, *_):
+        self.elapsed = time.time() - self.start
+
+
+def report(title, rows):
+    print(title)
+    for label, value in rows:
+        print('  {:<40} {}'.format(label, value))
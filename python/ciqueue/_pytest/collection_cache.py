@@ -0,0 +1,167 @@
+"""
+This module caches the names of the collected tests in Redis, by test file,
+under a fingerprint of everything that can change them: the test files and
+conftest.py files below the collected paths, the ini file, and the command line
+arguments but the queue url. With a warm cache, workers skip pytest's collection
+and only collect a test file when they reserve one of its tests.
+
+A test file is collected with `session.perform_collect`, so that plugins still
+modify and deselect its items, which runs `pytest_collection_modifyitems` and
+`pytest_collection_finish` once per collected file rather than once per session.
+"""
+
+from __future__ import absolute_import
+import collections
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+import zlib
+import pytest
+from ciqueue._pytest import test_queue
+
+# Entries of fingerprints nobody asked for in a week are evicted
+TTL = 7 * 24 * 60 * 60
+
+
+def rootdir(config):
+    return str(getattr(config, 'rootpath', None) or config.rootdir)
+
+
+def source_files(config):
+    norecursedirs = config.getini('norecursedirs')
+    inifile = getattr(config, 'inipath', None) or getattr(config, 'inifile', None)
+    files = set([str(inifile)]) if inifile else set()
+    for arg in config.args:
+        path = os.path.abspath(arg.split('::')[0])
+        # conftest.py files from the rootdir down to the argument apply to it
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        while True:
+            conftest = os.path.join(directory, 'conftest.py')
+            if os.path.exists(conftest):
+                files.add(conftest)
+            parent = os.path.dirname(directory)
+            if directory == rootdir(config) or parent == directory:
+                break
+            directory = parent
+
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = [d for d in dirnames if not any(fnmatch.fnmatch(d, p) for p in norecursedirs)]
+                files.update(os.path.join(dirpath, f) for f in filenames if f.endswith('.py'))
+        elif os.path.exists(path):
+            files.add(path)
+    return files
+
+
+def invocation_args(config):
+    """The command line arguments, e.g. --deselect, --ignore, -p and -o also change
+    the collected tests, without the --queue url, which changes with every build."""
+    invocation_params = getattr(config, 'invocation_params', None)
+    if invocation_params is None:
+        return []
+    args = []
+    skip = False
+    for arg in invocation_params.args:
+        if skip:
+            skip = False
+        elif arg == '--queue':
+            skip = True
+        elif not str(arg).startswith('--queue='):
+            args.append(str(arg))
+    return args
+
+
+def fingerprint(config):
+    digest = hashlib.sha1()
+    for value in (sys.version, pytest.__version__, config.args, invocation_args(config),
+                  config.getoption('keyword'), config.getoption('markexpr')):
+        digest.update(repr(value).encode('utf-8'))
+    for path in sorted(source_files(config)):
+        digest.update(os.path.relpath(path, rootdir(config)).encode('utf-8'))
+        with open(path, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def by_file(tests):
+    """Groups test names by the file they're defined in, keeping their order."""
+    files = collections.OrderedDict()
+    for test in tests:
+        files.setdefault(test.split('::', 1)[0], []).append(test)
+    return files
+
+
+def load(redis, key):
+    """Returns the cached [(file, [test, ...]), ...] or None."""
+    payload = redis.get(key)
+    if payload is None:
+        return None
+    redis.expire(key, TTL)
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def save(redis, key, tests):
+    payload = zlib.compress(json.dumps(list(by_file(tests).items())).encode('utf-8'))
+    redis.set(key, payload, ex=TTL)
+
+
+class MissingTest(pytest.Item):
+    """Stands for a cached test its file no longer collects, e.g. with parameters
+    that depend on the environment, or that a plugin deselects. It fails, so that
+    the worker reports and acknowledges it rather than dying while holding it."""
+
+    def runtest(self):
+        pytest.fail("{} is in the collection cache, but its file doesn't collect it".format(self.nodeid),
+                    pytrace=False)
+
+
+def missing_test(session, test):
+    if hasattr(MissingTest, 'from_parent'):
+        return MissingTest.from_parent(session, name=test, nodeid=test)
+    return MissingTest(test, parent=session, nodeid=test)
+
+
+class LazyItemIndex(object):
+    """Same interface as ciqueue.pytest.ItemIndex, over the cached test names.
+    A test file is collected the first time one of its tests is looked up."""
+
+    def __init__(self, session, files):
+        self.session = session
+        self.files = dict((path, set(tests)) for path, tests in files)
+        self.tests = [test for _, tests in files for test in tests]
+        self.index = {}
+
+    def __len__(self):
+        return len(self.tests)
+
+    def __getitem__(self, key):
+        if key not in self.index:
+            self._collect(key.split('::', 1)[0])
+        if key not in self.index:
+            self.index[key] = missing_test(self.session, key)
+        return self.index[key]
+
+    def __iter__(self):
+        return iter(self.tests)
+
+    def keys(self):
+        return list(self.tests)
+
+    def _collect(self, path):
+        session = self.session
+        # perform_collect replaces the session's items with the file's,
+        # and the terminal would report them as the whole collection
+        items, testscollected = session.items, session.testscollected
+        reporter = session.config.pluginmanager.get_plugin('terminalreporter')
+        if reporter:
+            reporter.report_collect = lambda final=False: None
+        try:
+            for item in session.perform_collect([os.path.join(rootdir(session.config), path)]):
+                if test_queue.key_item(item) in self.files.get(path, ()):
+                    self.index[test_queue.key_item(item)] = item
+        finally:
+            session.items, session.testscollected = items, testscollected
+            if reporter:
+                del reporter.report_collect
@@ -83,10 +83,14 @@ def marked_xfail(item):
     return hasattr(item, '_evalxfail') and item._evalxfail.istrue()  # pylint: disable=protected-access
 
 
+def skipped(excinfo):
+    return issubclass(excinfo.type, (Skipped, outcomes.Skipped))
+
+
 def failed(item):
     return hasattr(item, 'error_reports') and \
         not marked_xfail(item) and \
-        not all(issubclass(i['excinfo'].type, Skipped) for i in item.error_reports.values())
+        not all(skipped(i['excinfo']) for i in item.error_reports.values())
 
 
 def skipped_excinfo(item, msg):
@@ -0,0 +1,145 @@
+"""
+This module runs the tests of a node in `procs` processes forked once the tests
+are collected, so that they share the collected items. Each process is a worker
+of the build, with its own worker id, and sends the reports of the tests it ran
+to the parent, which logs them as if it had run them itself.
+"""
+
+from __future__ import absolute_import
+import os
+import signal
+import multiprocessing
+from multiprocessing import connection
+from _pytest import config as pytest_config
+from ciqueue import stats
+
+
+class Results(object):
+    """The worker end of the pipe, the reports of a test are sent once its teardown is reported."""
+
+    def __init__(self, config, conn):
+        self.config = config
+        self.conn = conn
+        self.reports = {}
+
+    def add(self, report):
+        data = self.config.hook.pytest_report_to_serializable(config=self.config, report=report)
+        self.reports.setdefault(report.nodeid, []).append(data)
+        if report.when == 'teardown':
+            self.conn.send(('reports', self.reports.pop(report.nodeid)))
+
+    def discard(self, nodeid):
+        """Forgets the reports of a test that will be retried or that another worker acknowledged."""
+        self.reports.pop(nodeid, None)
+
+
+class PoolReporter(object):
+
+    def __init__(self):
+        self.stats = stats.Stats()
+
+    def merge(self, data):
+        """Adds the stats a worker process sent to the node's."""
+        self.stats.merge(stats.Stats.loads(data))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep('=', 'ciqueue stats')
+        for line in self.stats.summary():
+            terminalreporter.write_line(line)
+
+
+def restart_capture(config):
+    """The forked worker gets its own capture files, the ones it inherited are the parent's."""
+    capman = config.pluginmanager.get_plugin('capturemanager')
+    if capman is not None:
+        capman.stop_global_capturing()
+        capman.start_global_capturing()
+        capman.suspend_global_capture()
+
+
+def silence_terminal(config):
+    reporter = config.pluginmanager.get_plugin('terminalreporter')
+    if reporter is not None:
+        reporter._tw = pytest_config.create_terminal_writer(  # pylint: disable=protected-access
+            config, open(os.devnull, 'w'))
+
+
+def log_reports(config, data):
+    reports = [config.hook.pytest_report_from_serializable(config=config, data=d) for d in data]
+    config.hook.pytest_runtest_logstart(nodeid=reports[0].nodeid, location=reports[0].location)
+    for report in reports:
+        config.hook.pytest_runtest_logreport(report=report)
+
+
+def _work(session, worker, proc, conn):
+    # The parent's handler is for the parent, the worker installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    config = session.config
+    restart_capture(config)
+    silence_terminal(config)
+    try:
+        queue = worker(proc, Results(config, conn))
+    except KeyboardInterrupt:
+        return
+    queue.flush()
+    if hasattr(queue, 'stats'):
+        conn.send(('stats', queue.stats.dumps()))
+    conn.close()
+
+
+def _fork(session, worker, proc, processes):
+    """Starts the worker process `proc`, and returns the end of the pipe it sends its reports to."""
+    context = multiprocessing.get_context('fork')
+    reader, writer = context.Pipe(duplex=False)
+    process = context.Process(target=_work, args=(session, worker, proc, writer))
+    process.start()
+    writer.close()
+    processes.append(process)
+    return reader
+
+
+def _receive(session, readers, reporter):
+    """Logs what the worker processes send until they all closed their pipe."""
+    while readers:
+        for reader in connection.wait(readers):
+            try:
+                kind, data = reader.recv()
+            except EOFError:
+                readers.remove(reader)
+                continue
+            if kind == 'reports':
+                log_reports(session.config, data)
+            else:
+                reporter.merge(data)
+        if session.shouldstop:
+            raise session.Interrupted(session.shouldstop)
+
+
+def run(session, procs, worker):
+    """Forks `procs` processes that each call `worker(proc, results)`, which runs the
+    tests and returns the queue, and logs the reports they send back."""
+    reporter = PoolReporter()
+    session.config.pluginmanager.register(reporter)
+
+    # Like a KeyboardInterrupt, the workers are terminated and release their tests
+    def interrupt(signum, frame):  # pylint: disable=unused-argument
+        raise session.Interrupted("Received SIGTERM")
+
+    previous_sigterm = signal.signal(signal.SIGTERM, interrupt)
+    processes = []
+    try:
+        readers = [_fork(session, worker, proc, processes) for proc in range(procs)]
+        _receive(session, readers, reporter)
+    except KeyboardInterrupt:
+        # The workers release the tests they hold on SIGTERM
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+        signal.signal(signal.SIGTERM, previous_sigterm if previous_sigterm is not None else signal.SIG_DFL)
+
+    crashed = ['{} ({})'.format(proc, process.exitcode) for proc, process in enumerate(processes) if process.exitcode]
+    if crashed:
+        raise session.Failed('ciqueue worker processes exited with an error: {}'.format(', '.join(crashed)))
@@ -0,0 +1,74 @@
+"""
+This module encodes the error reports of a test into the value stored in the
+`error-reports` hash, and decodes it back for `ciqueue.pytest_report`.
+
+The default, compact format only holds the reports as pytest renders them:
+each failed or skipped phase goes through pytest's own report serialization
+(longrepr, sections, location, when and duration), as JSON compressed with
+zlib behind a versioned prefix. The original format, a pickle of the whole
+`CallInfo` including the traceback, is kept for pytest versions without
+report serialization and for whoever asks for it.
+"""
+
+from __future__ import absolute_import
+import json
+import zlib
+import dill
+from ciqueue._pytest import outcomes
+
+# zlib streams never start with a NUL byte, which sets apart pickled reports
+PREFIX = b'\x00ciqueue:'
+VERSION = 1
+
+COMPACT = 'compact'
+PICKLE = 'pickle'
+FORMATS = (COMPACT, PICKLE)
+
+
+def supports_compact(config):
+    return hasattr(config.hook, 'pytest_report_to_serializable')
+
+
+def is_compact(payload):
+    return payload.startswith(PREFIX)
+
+
+def encode(config, reports):
+    """Encodes a dict of {when: TestReport}."""
+    data = dict((when, config.hook.pytest_report_to_serializable(config=config, report=report))
+                for when, report in reports.items())
+    # Plugins and `record_property` can put anything in user_properties
+    body = zlib.compress(json.dumps(data, separators=(',', ':'), default=repr).encode('utf-8'))
+    return PREFIX + str(VERSION).encode() + b':' + body
+
+
+def decode(config, payload):
+    """Returns the dict of {when: TestReport} encoded in `payload`."""
+    version, body = payload[len(PREFIX):].split(b':', 1)
+    if int(version) != VERSION:
+        raise ValueError("Unsupported error reports version {}, expected {}".format(int(version), VERSION))
+
+    reports = {}
+    for when, data in json.loads(zlib.decompress(body).decode('utf-8')).items():
+        if isinstance(data.get('longrepr'), list):
+            # A skip location tuple that went through JSON
+            data['longrepr'] = tuple(data['longrepr'])
+        reports[when] = config.hook.pytest_report_from_serializable(config=config, data=data)
+    return reports
+
+
+def encode_pickle(error_reports):
+    """Encodes a dict of {when: call_dict}, where call_dict is a copy of the CallInfo's `__dict__`."""
+    serializable = {}
+    for when, call_dict in error_reports.items():
+        call_dict = call_dict.copy()
+        call_dict['excinfo'] = outcomes.swap_in_serializable(call_dict['excinfo'])
+        serializable[when] = call_dict
+    return zlib.compress(dill.dumps(serializable))
+
+
+def decode_pickle(payload):
+    error_reports = dill.loads(zlib.decompress(payload))
+    for _, call_dict in error_reports.items():
+        call_dict['excinfo'] = outcomes.swap_back_original(call_dict['excinfo'])
+    return error_reports
@@ -4,6 +4,23 @@ import ciqueue.distributed
 import redis
 import uritools
 
+try:
+    from redis.cluster import RedisCluster
+except ImportError:  # redis-py < 4.1
+    RedisCluster = None
+
+
+REDIS_SCHEMES = ('redis', 'rediss')
+# A node of a Redis Cluster, e.g. redis+cluster://<host>:7000
+CLUSTER_SCHEMES = ('redis+cluster', 'rediss+cluster')
+
+# `retry=failed` only replays the tests the worker failed
+RETRY_FAILED = 'failed'
+
+# The Redis clients of the process by connection arguments, so that every queue
+# built for the same server shares a connection pool.
+_clients = {}
+
 
 class InvalidRedisUrl(Exception):
     pass
@@ -23,6 +40,23 @@ def strtobool(value):
     raise ValueError("invalid truth value {!r}".format(value))
 
 
+def parse_retry(value):
+    return value if value == RETRY_FAILED else int(value)
+
+
+def parse_options(args):
+    return ciqueue.distributed.Options(
+        batch_size=int(args.get('batch_size', [1])[0]),
+        write_behind=int(args.get('write_behind', [0])[0]),
+        heartbeat_interval=float(args.get('heartbeat_interval', [0])[0]),
+        durations_key=args.get('durations_key', [None])[0],
+        default_duration=float(args['default_duration'][0]) if 'default_duration' in args else None,
+        failures_key=args.get('failures_key', [None])[0],
+        group_by=args.get('group_by', [None])[0],
+        timeout_multiplier=float(args.get('timeout_multiplier', [0])[0]),
+    )
+
+
 def parse_worker_args(query_string, tests_index):
     args = urlparse.parse_qs(query_string)
 
@@ -35,7 +69,10 @@ def parse_worker_args(query_string, tests_index):
         'timeout': float(args.get('timeout', [0])[0]),
         'max_requeues': int(args.get('max_requeues', [0])[0]),
         'requeue_tolerance': float(args.get('requeue_tolerance', [0])[0]),
-        'retry': int(args.get('retry', [0])[0]),
+        'retry': parse_retry(args.get('retry', [0])[0]),
+        'intern_ids': strtobool(args.get('intern_ids', ['false'])[0]),
+        'ttl': int(args.get('ttl', [ciqueue.distributed.Worker.DEFAULT_TTL])[0]),
+        'options': parse_options(args),
     }
 
     if tests_index:
@@ -61,32 +98,93 @@ def parse_redis_args(spec):
         result['socket_connect_timeout'] = int(query['socket_connect_timeout'][0])
     if 'retry_on_timeout' in query:
         result['retry_on_timeout'] = strtobool(query['retry_on_timeout'][0] or 'false')
-    if spec.scheme == "rediss":
+    if spec.scheme in ('rediss', 'rediss+cluster'):
         result['ssl'] = True
 
     return result
 
 
-def build_queue(queue_url, tests_index=None):
+def redis_client(spec):
+    redis_args = parse_redis_args(spec)
+    key = (spec.scheme,) + tuple(sorted(redis_args.items()))
+    if key not in _clients:
+        if spec.scheme in CLUSTER_SCHEMES:
+            if RedisCluster is None:
+                raise InvalidRedisUrl("The {} scheme requires redis-py 4.1 or later".format(spec.scheme))
+            # A cluster only has database 0
+            del redis_args['db']
+            redis_args['port'] = int(redis_args.get('port', 6379))
+            _clients[key] = RedisCluster(**redis_args)
+        else:
+            _clients[key] = redis.StrictRedis(**redis_args)
+    return _clients[key]
+
+
+def collection_cache(queue_url):
+    """Returns the Redis client and the key prefix of the collection cache, if the url sets one."""
+    spec = uritools.urisplit(queue_url)
+    if spec.scheme not in REDIS_SCHEMES + CLUSTER_SCHEMES:
+        return None
+    key = urlparse.parse_qs(spec.query).get('collection_cache_key', [None])[0]
+    if not key:
+        return None
+    return redis_client(spec), key
+
+
+def worker_procs(queue_url):
+    """How many worker processes the node runs, see ciqueue._pytest.pool."""
+    spec = uritools.urisplit(queue_url)
+    if spec.scheme not in REDIS_SCHEMES + CLUSTER_SCHEMES:
+        return 1
+    return int(urlparse.parse_qs(spec.query).get('procs', [1])[0])
+
+
+def proc_worker_id(worker_id, proc):
+    return '{}.{}'.format(worker_id, proc)
+
+
+def failed_tests(queue_url):
+    """The tests a `retry=failed` queue replays, so that only their files are collected.
+    None for any other queue."""
+    spec = uritools.urisplit(queue_url)
+    if spec.scheme not in REDIS_SCHEMES + CLUSTER_SCHEMES:
+        return None
+    worker_args = parse_worker_args(spec.query, tests_index=True)
+    if worker_args.pop('retry') != RETRY_FAILED:
+        return None
+
+    procs = worker_procs(queue_url)
+    worker_ids = [worker_args['worker_id']]
+    if procs > 1:
+        worker_ids = [proc_worker_id(worker_ids[0], proc) for proc in range(procs)]
+    # Only reads the build, without registering or electing a leader like a worker
+    build = ciqueue.distributed.Supervisor(redis=redis_client(spec), build_id=worker_args['build_id'])
+    tests = []
+    for worker_id in worker_ids:
+        tests.extend(build.failed_tests(worker_id))
+    return tests
+
+
+def build_queue(queue_url, tests_index=None, proc=None):
     spec = uritools.urisplit(queue_url)
     if spec.scheme == 'list':
         return ciqueue.Static(spec.path.split(':'))
     elif spec.scheme == 'file':
         return ciqueue.File(spec.path)
-    elif spec.scheme == 'redis' or spec.scheme == 'rediss':
-        redis_args = parse_redis_args(spec)
-        redis_client = redis.StrictRedis(**redis_args)
+    elif spec.scheme in REDIS_SCHEMES + CLUSTER_SCHEMES:
+        client = redis_client(spec)
 
         worker_args = parse_worker_args(spec.query, tests_index)
-        retry = bool(worker_args['retry'])
-        del worker_args['retry']
+        retry = worker_args.pop('retry')
+        if proc is not None and tests_index:
+            worker_args['worker_id'] = proc_worker_id(worker_args['worker_id'], proc)
 
         klass = ciqueue.distributed.Worker
         if tests_index is None:
             klass = ciqueue.distributed.Supervisor
-        queue = klass(tests=tests_index, redis=redis_client, **worker_args)
+        queue = klass(tests=tests_index, redis=client, **worker_args)
         if retry and tests_index:
-            queue = queue.retry_queue()
+            queue = queue.retry_queue(failed_only=retry == RETRY_FAILED)
         return queue
     else:
         raise "Unknown queue scheme: " + repr(spec.scheme)
@@ -1,51 +1,136 @@
-import os
 import time
 import math
+import collections
+import threading
 import redis
 
+from future.moves import queue as Queue
 from past.builtins import xrange  # pylint: disable=redefined-builtin,import-modules-only
 
+from ciqueue import durations
+from ciqueue import failures
+from ciqueue import scripts
 from ciqueue import static
+from ciqueue import stats
 
 
 class LostMaster(Exception):
     pass
 
 
+def build_key(build_id, *args):
+    """The build id is a hash tag, so that on Redis Cluster all the keys of a
+    build, which the scripts use together, live in the same slot."""
+    return ':'.join(['build', '{' + str(build_id) + '}'] + [str(i) for i in args])
+
+
 class Base(object):
+    # Longest we block waiting for an event, in case a notification was missed
+    # (e.g. published by a client that doesn't pass the events channel).
+    IDLE_WAIT = 2
 
     def __init__(self, redis, build_id):
         self.redis = redis
         self.build_id = str(build_id)
         self.is_master = False
         self.total = None
-        self._scripts = {}
+        # When the build interns test ids, the queue holds small integer ids
+        # and these map them to and from the test names. None until loaded.
+        self._test_names = None
+        self._test_ids = None
 
     def key(self, *args):
-        return ':'.join(['build', self.build_id] + [str(i) for i in args])
+        return build_key(self.build_id, *args)
+
+    def test_name(self, entry):
+        """Returns the name of the test stored as `entry` in the build's keys."""
+        if self._test_names is None:
+            self._load_test_ids()
+        if self._test_names:
+            return self._test_names[int(entry)]
+        return entry
+
+    def _entry(self, test):
+        if self._test_ids is None:
+            self._load_test_ids()
+        return self._test_ids.get(test, test)
+
+    def _load_test_ids(self):
+        self._set_test_names([name.decode() for name in self.redis.lrange(self.key('test-ids'), 0, -1)])
+
+    def _set_test_names(self, names):
+        self._test_names = names
+        self._test_ids = dict((name, str(i)) for i, name in enumerate(names))
 
     def wait_for_master(self, timeout=10):
         if self.is_master:
             return True
 
-        for _ in xrange(timeout * 10 + 1):
-            master_status = self._master_status()
-            if master_status in ['ready', 'finished']:
-                return True
-            time.sleep(0.1)
+        deadline = time.time() + timeout
+        events = self._subscribe()
+        try:
+            while True:
+                master_status = self._master_status()
+                if master_status in ['ready', 'finished']:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._wait_for_event(events, min(remaining, self.IDLE_WAIT))
+        finally:
+            events.close()
 
         raise LostMaster(
             "The master worker is still `" +
             repr(master_status) +
             "` after {} seconds waiting.".format(timeout))
 
+    def error_reports(self, tests):
+        """Returns the error report of each test, None for the tests without one."""
+        tests = list(tests)
+        if not tests:
+            return []
+        return self.redis.hmget(self.key('error-reports'), [self._entry(test) for test in tests])
+
+    def failed_tests(self, worker_id):
+        """Returns the tests `worker_id` failed, sorted, see Worker.retry_queue."""
+        return sorted(self.test_name(entry.decode()) for entry in self.redis.smembers(
+            self.key('worker', worker_id, 'failed')))
+
+    def build_stats(self):
+        """Returns the stats published by every worker of the build, merged."""
+        build_stats = stats.Stats()
+        for payload in self.redis.hvals(self.key('stats')):
+            build_stats.merge(stats.Stats.loads(payload))
+        return build_stats
+
+    def _subscribe(self):
+        events = self.redis.pubsub(ignore_subscribe_messages=True)
+        events.subscribe(self.key('events'))
+        return events
+
+    @staticmethod
+    def _wait_for_event(events, timeout):
+        """Blocks until something is published on the build's events channel, or
+        for `timeout` seconds. Events received since the last call make it return
+        right away, the caller then checks the queue once more before blocking."""
+        deadline = time.time() + timeout
+        while True:
+            if events.get_message(timeout=max(deadline - time.time(), 0)):
+                while events.get_message(timeout=0):
+                    pass
+                return
+            if time.time() >= deadline:
+                return
+
     def _master_status(self):
         raw = self.redis.get(self.key('master-status'))
         return raw.decode() if raw else None
 
     def __len__(self):
-        transaction = self.redis.pipeline(transaction=True)
+        transaction = scripts.transaction(self.redis)
         transaction.llen(self.key('queue'))
+        transaction.zcard(self.key('deferred-queue'))
         transaction.zcard(self.key('running'))
         return sum(transaction.execute())
 
@@ -54,61 +139,201 @@ class Base(object):
         return self.total - len(self)
 
 
+class Options(collections.namedtuple('Options', ['batch_size', 'write_behind', 'heartbeat_interval', 'durations_key',
+                                                 'default_duration', 'failures_key', 'group_by',
+                                                 'timeout_multiplier'])):
+    """How a worker orders, reserves and times out the tests, see the README. The
+    ordering options only matter on the leader, which pushes the tests."""
+    __slots__ = ()
+
+    def __new__(cls, batch_size=1, write_behind=0, heartbeat_interval=0,  # pylint: disable=too-many-arguments
+                durations_key=None, default_duration=None, failures_key=None, group_by=None, timeout_multiplier=0):
+        if group_by not in (None, 'module', 'class'):
+            raise ValueError("group_by must be 'module' or 'class', got {!r}".format(group_by))
+        return super(Options, cls).__new__(cls, max(int(batch_size), 1), write_behind, heartbeat_interval,
+                                           durations_key, default_duration, failures_key, group_by,
+                                           timeout_multiplier)
+
+
 class Worker(Base):
     distributed = True
+    # The leader seeds the queue with commands of at most PUSH_CHUNK_SIZE tests,
+    # and sends them in pipelines of about PUSH_BATCH_SIZE tests.
+    PUSH_CHUNK_SIZE = 1000
+    PUSH_BATCH_SIZE = 20000
+    # Shortest timeout given to a test from its duration history
+    MIN_TEST_TIMEOUT = 5
+    # Every key of the build expires `ttl` seconds after the last activity of a
+    # worker, which pushes the expiry back at most every TTL_REFRESH_INTERVAL seconds.
+    DEFAULT_TTL = 8 * 60 * 60
+    TTL_REFRESH_INTERVAL = 60
+    BUILD_KEYS = ('queue', 'deferred-queue', 'queue-pops', 'running', 'processed', 'owners', 'leases',
+                  'lease-counter', 'requeued-by', 'requeues-count', 'error-reports', 'workers', 'stats',
+                  'test-ids', 'groups', 'timeout-offsets', 'total', 'master-status')
+    WORKER_KEYS = ('queue', 'owned', 'failed')
 
     def __init__(self, tests, worker_id, redis, build_id,  # pylint: disable=too-many-arguments
-                 timeout, max_requeues=0, requeue_tolerance=0):
+                 timeout, max_requeues=0, requeue_tolerance=0, intern_ids=False, ttl=DEFAULT_TTL, options=None):
         super(Worker, self).__init__(redis=redis, build_id=build_id)
         self.timeout = timeout
         self.total = len(tests)
         self._leases = {}
+        self._reserved = collections.deque()
         self.max_requeues = max_requeues
         self.global_max_requeues = math.ceil(len(tests) * requeue_tolerance)
         self.worker_id = worker_id
         self.shutdown_required = False
+        # Only the leader's setting matters, the others find out from `test-ids`
+        self.intern_ids = intern_ids
+        self.options = options = options or Options()
+        self._write_behind = WriteBehind(redis, options.write_behind) if options.write_behind else None
+        self._heartbeat = Heartbeat(self, options.heartbeat_interval) if options.heartbeat_interval else None
+        self.durations = durations.Durations(redis, options.durations_key) if options.durations_key else None
+        self._new_durations = {}
+        self.failures = failures.Failures(redis, options.failures_key) if options.failures_key else None
+        self._new_results = {}
+        self.ttl = int(ttl)
+        self._ttl_refreshed_at = None
+        self._events = None
+        self.stats = stats.Stats()
         self._push(tests)
 
     def __iter__(self):
         def poll():
-            while not self.shutdown_required and len(self):  # pylint: disable=len-as-condition
+            # While we still hold reserved tests the queue can't be empty,
+            # so there is no need to ask Redis for its length.
+            while not self.shutdown_required and (self._reserved or len(self)):
                 test = self._reserve()
                 if test:
-                    yield test.decode() if isinstance(test, bytes) else test
+                    yield self.test_name(test.decode() if isinstance(test, bytes) else test)
+                elif self._events is None:
+                    # Subscribe before trying again, so that nothing happens unnoticed
+                    self._events = self._subscribe()
                 else:
-                    time.sleep(0.05)
+                    with self.stats.time('idle'):
+                        self._wait_for_event(self._events, self._idle_timeout())
 
         try:
             self.wait_for_master()
+            if self._heartbeat:
+                self._heartbeat.start()
             for i in poll():
                 yield i
         except redis.ConnectionError:
             pass
+        finally:
+            if self._heartbeat:
+                self._heartbeat.stop()
+            self._unreserve()
+            self.flush()
+            if self._events:
+                self._events.close()
+                self._events = None
 
     def shutdown(self):
         self.shutdown_required = True
 
-    def acknowledge(self, test):
+    def peek(self):
+        """Returns the test that will come next if it's already reserved, else None."""
+        if self._reserved:
+            return self.test_name(self._reserved[0])
+        return None
+
+    def flush(self):
+        """Writes what the worker kept for later. Raises the first error of the
+        write-behind thread, once everything else is written."""
+        try:
+            if self._write_behind:
+                self._write_behind.close()
+        finally:
+            self._write_records()
+
+    def _write_records(self):
+        if self._new_durations:
+            new_durations, self._new_durations = self._new_durations, {}
+            try:
+                self.durations.record(new_durations)
+            except redis.ConnectionError:
+                pass
+        if self._new_results:
+            new_results, self._new_results = self._new_results, {}
+            try:
+                self.failures.record(new_results)
+            except redis.ConnectionError:
+                pass
+        try:
+            self.redis.hset(self.key('stats'), self.worker_id, self.stats.dumps())
+            self._refresh_ttl(force=True)
+        except redis.ConnectionError:
+            pass
+
+    def record_duration(self, test, duration):
+        """Keeps the test duration to be written to the durations history on flush."""
+        if self.durations:
+            self._new_durations[test] = duration
+
+    def record_result(self, test, failed):
+        """Keeps whether the test failed to be written to the failure scores on flush."""
+        if self.failures:
+            self._new_results[test] = failed
+
+    def release(self):
+        """Stops the worker and gives up every test it holds right away. Reserved tests
+        go back to the queue, and running ones are marked as lost so that peers pick
+        them up on their next reserve instead of waiting for `timeout` to expire."""
+        self.shutdown_required = True
+        if self._heartbeat:
+            self._heartbeat.stop()
+        try:
+            self.flush()
+        except redis.RedisError:
+            # The tests whose acknowledgement was lost are released below
+            pass
+        self._unreserve()
+        self._leases.clear()
+        try:
+            self._eval_script(
+                'release',
+                keys=[
+                    self.key('running'),
+                    self.key('worker', self.worker_id, 'queue'),
+                    self.key('owners'),
+                    self.key('leases'),
+                    self.key('events'),
+                ],
+            )
+        except redis.ConnectionError:
+            pass
+
+    def acknowledge(self, test, error='', always_record=False):
+        """Returns whether this worker was the first to acknowledge the test.
+        With `always_record` the result is written whatever the answer is, so
+        when write-behind is enabled the call is deferred and returns None."""
+        test = self._entry(test)
         lease = self._leases.pop(test, '')
-        return self._eval_script(
-            'acknowledge',
-            keys=[
-                self.key('running'),
-                self.key('processed'),
-                self.key('owners'),
-                self.key('error-reports'),
-                self.key('requeued-by'),
-                self.key('leases'),
-            ],
-            args=[test, '', 0, lease],
-        ) == 1
+        keys = [
+            self.key('running'),
+            self.key('processed'),
+            self.key('owners'),
+            self.key('error-reports'),
+            self.key('requeued-by'),
+            self.key('leases'),
+            self.key('events'),
+            self.key('worker', self.worker_id, 'failed'),
+        ]
+        args = [test, error, self.ttl, lease, 1 if always_record else 0]
+        if always_record and self._write_behind:
+            self._write_behind.submit(self._script('acknowledge'), keys, args)
+            return None
+        return self._eval_script('acknowledge', keys=keys, args=args) == 1
 
     def requeue(self, test, offset=42):
         if not (self.max_requeues > 0 and self.global_max_requeues > 0.0):
             return False
 
+        test = self._entry(test)
         lease = self._leases.get(test, '')
-        return self._eval_script(
+        requeued = self._eval_script(
             'requeue',
             keys=[
                 self.key('processed'),
@@ -120,26 +345,97 @@ class Worker(Base):
                 self.key('error-reports'),
                 self.key('requeued-by'),
                 self.key('leases'),
+                self.key('deferred-queue'),
+                self.key('queue-pops'),
+                self.key('events'),
             ],
-            args=[self.max_requeues, self.global_max_requeues, test, offset, 0, lease],
+            args=[self.max_requeues, self.global_max_requeues, test, offset, self.ttl, lease],
         ) == 1
-
-    def retry_queue(self):
-        tests = [v.decode() for v in self.redis.lrange(
-            self.key('worker', self.worker_id, 'queue'), 0, -1)]
-        tests.reverse()
+        if requeued:
+            self._leases.pop(test, None)
+            self.stats.incr('requeued')
+        return requeued
+
+    def heartbeat(self):
+        """Bumps the running score of every test we hold a lease on, so they
+        aren't considered lost while we're still working on them."""
+        leases = self._leases.copy()
+        if not leases:
+            return
+        # Reserved tests waiting for their turn keep the global timeout
+        buffered = set(self._reserved)
+        script = self._script('heartbeat')
+        keys = [self.key('running'), self.key('leases'), self.key('timeout-offsets')]
+        now = time.time()
+        scripts.execute(self.redis, [(script, keys[:2] if test in buffered else keys, [now, test, lease])
+                                     for test, lease in leases.items()])
+
+    def retry_queue(self, failed_only=False):
+        """Replays the tests this worker ran, in the same order, or with `failed_only`
+        the ones it failed, i.e. acknowledged with an error but without `always_record`."""
+        if failed_only:
+            tests = self.failed_tests(self.worker_id)
+        else:
+            tests = [self.test_name(v.decode()) for v in self.redis.lrange(
+                self.key('worker', self.worker_id, 'queue'), 0, -1)]
+            tests.reverse()
         return Retry(
             tests,
             redis=self.redis,
             build_id=self.build_id,
+            test_ids=self._test_ids,
+            worker_id=self.worker_id,
+            ttl=self.ttl,
         )
 
     def _push(self, tests):
         def push(tests):
-            transaction = self.redis.pipeline(transaction=True)
-            transaction.lpush(self.key('queue'), *tests)
+            tests = list(tests)
+            history = self.durations.fetch(tests) if self.durations else None
+            scores = self.failures.fetch(tests) if self.failures else None
+            groups = None
+            if self.options.group_by:
+                groups = group_tests(tests, self.options.group_by)
+                if self.durations:
+                    # Longest groups first, the tests of a group keep their order
+                    estimates = self.durations.estimates(tests, self.options.default_duration, history)
+                    groups.sort(key=lambda group: sum(estimates[test] for test in group), reverse=True)
+                if scores:
+                    # Groups of the tests most likely to fail before all others
+                    groups.sort(key=lambda group: max(scores.get(test, 0.0) for test in group), reverse=True)
+                tests = [test for group in groups for test in group]
+            elif self.durations:
+                # Longest tests first, so that no slow test is left for the end of the build
+                tests = self.durations.longest_first(tests, self.options.default_duration, history)
+            if scores and not groups:
+                # Tests that failed recently first, for a faster feedback on red builds
+                tests = self.failures.likely_first(tests, scores)
+
+            timeouts = self._test_timeouts(history) if history else {}
+            if not self.intern_ids:
+                self._set_test_names([])
+            else:
+                # Store every name once, the queue and every other key only hold its index
+                self._set_test_names(tests)
+                self._send_in_batches(('rpush', self.key('test-ids'), chunk)
+                                      for chunk in chunks(self._test_names, self.PUSH_CHUNK_SIZE))
+                tests = [self._test_ids[name] for name in self._test_names]
+            if groups:
+                self._send_in_batches(('hset', self.key('groups'), [self._test_ids.get(test, test), index])
+                                      for index, group in enumerate(groups) for test in group)
+            if timeouts:
+                self._send_in_batches(('hset', self.key('timeout-offsets'),
+                                       [self._test_ids.get(test, test), timeout - self.timeout])
+                                      for test, timeout in timeouts.items())
+            # Workers don't look at the queue until the master is ready
+            self._send_in_batches(('lpush', self.key('queue'), chunk)
+                                  for chunk in chunks(tests, self.PUSH_CHUNK_SIZE))
+
+            transaction = scripts.transaction(self.redis)
             transaction.set(self.key('total'), self.total)
             transaction.set(self.key('master-status'), 'ready')
+            # Cluster pipelines don't have a publish method
+            transaction.execute_command('PUBLISH', self.key('events'), 'ready')
             transaction.execute()
 
         try:
@@ -151,46 +447,117 @@ class Worker(Base):
                 push(tests)
 
             self._register()
+            self._refresh_ttl(force=True)
         except redis.ConnectionError:
             if self.is_master:
                 raise
 
+    def _test_timeouts(self, history):
+        """Gives tests with a history `timeout_multiplier` times their p95 duration
+        to run, or MIN_TEST_TIMEOUT seconds if that's longer, instead of `timeout`."""
+        multiplier = self.options.timeout_multiplier
+        if not (self.timeout and multiplier):
+            return {}
+        return dict((test, max(multiplier * durations.percentile(recent, 95), self.MIN_TEST_TIMEOUT))
+                    for test, recent in history.items())
+
+    def _send_in_batches(self, commands):
+        """Sends the (command, key, args) commands in pipelines of about PUSH_BATCH_SIZE arguments."""
+        pipeline = self.redis.pipeline(transaction=False)
+        pending = 0
+        for command, key, args in commands:
+            getattr(pipeline, command)(key, *args)
+            pending += len(args)
+            if pending >= self.PUSH_BATCH_SIZE:
+                pipeline.execute()
+                pending = 0
+        pipeline.execute()
+
     def _register(self):
         self.redis.sadd(self.key('workers'), self.worker_id)
 
-    def _reserve(self):
-        result = self._try_to_reserve_lost_test() or self._try_to_reserve_test()
-        if result:
-            if isinstance(result, list):
-                entry, lease = result[0], result[1]
-                # Store lease keyed by the decoded entry (acknowledge receives decoded strings)
-                entry_str = entry.decode() if isinstance(entry, bytes) else entry
-                lease_str = lease.decode() if isinstance(lease, bytes) else str(lease)
-                self._leases[entry_str] = lease_str
-                return entry  # Return raw (bytes or str) — poll() handles .decode()
-            else:
-                return result
-        return result
+    def _refresh_ttl(self, force=False):
+        """Sets the expiry of every key of the build, and of this worker's own keys,
+        to `ttl` seconds from now. Unless forced, at most every TTL_REFRESH_INTERVAL seconds."""
+        if not self.ttl:
+            return
+        now = time.time()
+        interval = min(self.TTL_REFRESH_INTERVAL, self.ttl / 2.0)
+        if not force and self._ttl_refreshed_at is not None and now < self._ttl_refreshed_at + interval:
+            return
+        self._ttl_refreshed_at = now
+        pipeline = self.redis.pipeline(transaction=False)
+        for name in self.BUILD_KEYS:
+            pipeline.expire(self.key(name), self.ttl)
+        for name in self.WORKER_KEYS:
+            pipeline.expire(self.key('worker', self.worker_id, name), self.ttl)
+        pipeline.execute()
 
-    def _try_to_reserve_lost_test(self):
-        if self.timeout:
-            return self._eval_script(
-                'reserve_lost',
+    def _reserve(self):
+        if not self._reserved:
+            result = self._try_to_reserve_test()
+            if result and self.timeout:
+                # With a timeout, lost tests come first and the reply says how many
+                self.stats.incr('reclaimed', int(result[0]))
+                result = result[1:]
+            self._buffer(result)
+            self._refresh_ttl()
+        if self._reserved:
+            return self._reserved.popleft()
+        return None
+
+    def _buffer(self, result):
+        # result = [test, lease, other_test, other_lease, ...]
+        if not result:
+            return
+        for entry, lease in zip(result[::2], result[1::2]):
+            # Store lease keyed by the decoded entry (acknowledge receives decoded strings)
+            entry_str = entry.decode() if isinstance(entry, bytes) else entry
+            lease_str = lease.decode() if isinstance(lease, bytes) else str(lease)
+            self._leases[entry_str] = lease_str
+            self._reserved.append(entry_str)
+            self.stats.incr('reserved')
+
+    def _unreserve(self):
+        """Give the tests we reserved but never ran back to the queue."""
+        if not self._reserved:
+            return
+        args = []
+        for test in self._reserved:
+            args.extend([test, self._leases.pop(test, '')])
+        self._reserved.clear()
+        try:
+            self._eval_script(
+                'unreserve',
                 keys=[
+                    self.key('queue'),
                     self.key('running'),
-                    self.key('completed'),
-                    self.key(
-                        'worker',
-                        self.worker_id,
-                        'queue'),
+                    self.key('worker', self.worker_id, 'queue'),
                     self.key('owners'),
                     self.key('leases'),
-                    self.key('lease-counter'),
+                    self.key('events'),
                 ],
-                args=[time.time(), self.timeout],
+                args=args,
             )
+        except redis.ConnectionError:
+            pass
 
-    def _try_to_reserve_test(self):
+    def _idle_timeout(self):
+        """How long we can wait for an event before a running test may be lost."""
+        if not self.timeout:
+            return self.IDLE_WAIT
+        oldest = self.redis.zrange(self.key('running'), 0, 0, withscores=True)
+        if not oldest:
+            return self.IDLE_WAIT
+        return min(max(oldest[0][1] + self.timeout - time.time(), 0.05), self.IDLE_WAIT)
+
+    def _try_to_reserve_test(self, batch_size=None):
+        """Reserves the oldest lost test if there's one and `timeout` is set,
+        else a batch of tests from the queue, in a single script call. With a
+        `batch_size` of 0 only lost tests are reserved."""
+        args = [time.time(), 42, self.options.batch_size if batch_size is None else batch_size]
+        if self.timeout:
+            args.append(self.timeout)
         return self._eval_script(
             'reserve',
             keys=[
@@ -203,29 +570,142 @@ class Worker(Base):
                 self.key('workers'),
                 self.key('leases'),
                 self.key('lease-counter'),
+                self.key('deferred-queue'),
+                self.key('queue-pops'),
+                self.key('groups'),
+                self.key('timeout-offsets'),
             ],
-            args=[
-                time.time(),
-                42,
-            ],
+            args=args,
         )
 
     def _eval_script(self, script_name, keys=None, args=None):
-        keys = keys or []
-        args = args or []
-        if script_name not in self._scripts:
-            filename = 'redis/' + script_name + '.lua'
+        with self.stats.time('script:' + script_name):
+            return self._script(script_name)(keys=keys, args=args, client=self.redis)
+
+    def _script(self, script_name):  # pylint: disable=no-self-use
+        return scripts.SCRIPTS[script_name]
+
+
+def chunks(items, size):
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def group_name(test, group_by):
+    """Returns the module, or the class, of a pytest node id."""
+    path = test.split('[', 1)[0].split('::')
+    if group_by == 'module' or len(path) < 3:
+        return path[0]
+    return '::'.join(path[:-1])
+
 
-            path = os.path.join(os.path.dirname(__file__), '../../', filename)
-            if not os.path.exists(path):
-                path = os.path.join(os.path.dirname(__file__), filename)
+def group_tests(tests, group_by):
+    """Gathers the tests by module or class, in the order they first appear."""
+    groups = collections.OrderedDict()
+    for test in tests:
+        groups.setdefault(group_name(test, group_by), []).append(test)
+    return list(groups.values())
 
-            with open(path) as script_file:
-                self._scripts[script_name] = self.redis.register_script(
-                    script_file.read())
 
-        script = self._scripts[script_name]
-        return script(keys=keys, args=args)
+class WriteBehind(object):
+    """Runs script calls nobody waits on from a background thread. Whatever piled
+    up while the previous batch was being written is sent in a single pipeline.
+    A batch that can't be written after `RETRIES` attempts is dropped, and the
+    first error is raised by the next `close`."""
+
+    STOP = object()
+    RETRIES = 3
+    # Seconds before the first retry, doubled on each of the next ones
+    RETRY_DELAY = 0.1
+
+    def __init__(self, redis, max_pending, max_batch=100):
+        self.redis = redis
+        self.pending = Queue.Queue(maxsize=max_pending)
+        self.max_batch = max_batch
+        self.thread = None
+        self.error = None
+
+    def submit(self, script, keys, args):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='ciqueue-write-behind')
+            self.thread.daemon = True
+            self.thread.start()
+        # Blocks when `max_pending` writes are already waiting.
+        self.pending.put((script, keys, args))
+
+    def close(self):
+        """Waits for every pending write, the thread is started again on the next submit."""
+        if self.thread is not None:
+            self.pending.put(self.STOP)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.pending.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except Queue.Empty:
+                    break
+
+            writes = [write for write in batch if write is not self.STOP]
+            stopping = len(writes) != len(batch)
+            try:
+                self._write(writes)
+            except Exception as error:  # pylint: disable=broad-except
+                # The thread keeps going, so that `submit` and `close` never
+                # wait on writes nobody takes anymore.
+                if self.error is None:
+                    self.error = error
+
+    def _write(self, writes):
+        if not writes:
+            return
+        for attempt in range(self.RETRIES):
+            try:
+                scripts.execute(self.redis, writes)
+                return
+            except redis.RedisError:
+                if attempt == self.RETRIES - 1:
+                    raise
+                time.sleep(self.RETRY_DELAY * 2 ** attempt)
+
+
+class Heartbeat(object):
+    """Calls `Worker.heartbeat` every `interval` seconds from a background thread.
+    When the worker dies the thread dies with it, so its tests are reclaimed once
+    `timeout` expires, which can then be much shorter than the slowest test."""
+
+    def __init__(self, worker, interval):
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name='ciqueue-heartbeat')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.worker.heartbeat()
+            except redis.RedisError:
+                pass
 
 
 class Supervisor(Base):
@@ -240,19 +720,58 @@ class Supervisor(Base):
         if not self.wait_for_master(timeout=master_timeout):
             return False
 
-        while len(self):  # pylint: disable=len-as-condition
-            time.sleep(0.1)
+        events = self._subscribe()
+        try:
+            while len(self):  # pylint: disable=len-as-condition
+                self._wait_for_event(events, self.IDLE_WAIT)
+        finally:
+            events.close()
 
         return True
 
+    def compact(self):
+        """Drops the list of the tests each worker ran, and the set of the tests it
+        held, once the build is reported. Only `retry=failed` works after that, the
+        failed sets and the error reports are kept until the build expires."""
+        workers = [worker_id.decode() for worker_id in self.redis.smembers(self.key('workers'))]
+        keys = [self.key('worker', worker_id, name) for worker_id in workers for name in ('queue', 'owned')]
+        if keys:
+            self.redis.delete(*keys)
+
 
 class Retry(static.Static):
     distributed = True
 
-    def __init__(self, tests, redis, build_id):
+    def __init__(self, tests, redis, build_id,  # pylint: disable=too-many-arguments
+                 test_ids=None, worker_id=None, ttl=0):
         super(Retry, self).__init__(tests)
         self.redis = redis
         self.build_id = build_id
+        self.test_ids = test_ids or {}
+        self.worker_id = worker_id
+        self.ttl = ttl
 
     def key(self, *args):
-        return ':'.join(['build', self.build_id] + map(str, args))
+        return build_key(self.build_id, *args)
+
+    def acknowledge(self, test, error='', always_record=False):
+        # Retried tests aren't leased, so the latest run always owns the report.
+        entry = self.test_ids.get(test, test)
+        pipeline = self.redis.pipeline(transaction=False)
+        if error:
+            pipeline.hset(self.key('error-reports'), entry, error)
+            if self.ttl:
+                pipeline.expire(self.key('error-reports'), self.ttl)
+        else:
+            pipeline.hdel(self.key('error-reports'), entry)
+        if self.worker_id is not None:
+            # So that the next retry of the failures only runs what's still failing
+            failed_key = self.key('worker', self.worker_id, 'failed')
+            if error and not always_record:
+                pipeline.sadd(failed_key, entry)
+                if self.ttl:
+                    pipeline.expire(failed_key, self.ttl)
+            else:
+                pipeline.srem(failed_key, entry)
+        pipeline.execute()
+        return True
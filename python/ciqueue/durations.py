@@ -0,0 +1,67 @@
+import math
+
+HISTORY_SIZE = 10
+# Hashes are read with HMGETs of at most FETCH_CHUNK_SIZE fields
+FETCH_CHUNK_SIZE = 1000
+
+
+def hmget(redis, key, fields):
+    """Returns the {field: value} of the `fields` the hash has, with HMGETs
+    sent in a single pipeline."""
+    fields = list(fields)
+    if not fields:
+        return {}
+    pipeline = redis.pipeline(transaction=False)
+    for start in range(0, len(fields), FETCH_CHUNK_SIZE):
+        pipeline.hmget(key, fields[start:start + FETCH_CHUNK_SIZE])
+    values = [value for chunk in pipeline.execute() for value in chunk]
+    return dict((field, value) for field, value in zip(fields, values) if value)
+
+
+def mean(values):
+    values = list(values)
+    return sum(values) / len(values) if values else 0.0
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(int(math.ceil(len(values) * percent / 100.0)) - 1, 0)]
+
+
+class Durations(object):
+    """Durations of tests across builds, kept in a hash that isn't scoped to a build.
+    Each field holds the last `history_size` durations of a test, comma separated."""
+
+    def __init__(self, redis, key, history_size=HISTORY_SIZE):
+        self.redis = redis
+        self.key = key
+        self.history_size = history_size
+
+    def fetch(self, tests):
+        return dict((test, [float(d) for d in value.decode().split(',')])
+                    for test, value in hmget(self.redis, self.key, tests).items())
+
+    def record(self, durations):
+        if not durations:
+            return
+        history = self.fetch(durations)
+        pipeline = self.redis.pipeline(transaction=False)
+        for test, duration in durations.items():
+            recent = (history.get(test, []) + [duration])[-self.history_size:]
+            pipeline.hset(self.key, test, ','.join('{:.3f}'.format(d) for d in recent))
+        pipeline.execute()
+
+    def estimates(self, tests, default=None, history=None):
+        """Returns the expected duration of each test, tests without history are
+        expected to take `default` seconds, or the average of the others."""
+        tests = list(tests)
+        if history is None:
+            history = self.fetch(tests)
+        estimates = dict((test, mean(durations)) for test, durations in history.items())
+        if default is None:
+            default = mean(estimates.values())
+        return dict((test, estimates.get(test, default)) for test in tests)
+
+    def longest_first(self, tests, default=None, history=None):
+        estimates = self.estimates(tests, default, history)
+        return sorted(estimates, key=estimates.get, reverse=True)
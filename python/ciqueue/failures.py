@@ -0,0 +1,40 @@
+from ciqueue import durations
+
+DECAY = 0.5
+# Scores below MIN_SCORE are dropped, so the hash only holds recent failures
+MIN_SCORE = 0.01
+
+
+class Failures(object):
+    """Failure scores of tests across builds, kept in a hash that isn't scoped to a build.
+    Each run of a test multiplies its score by `decay`, and a failure adds 1 to it,
+    so a test that failed in the last builds scores higher than one that failed long ago."""
+
+    def __init__(self, redis, key, decay=DECAY):
+        self.redis = redis
+        self.key = key
+        self.decay = decay
+
+    def fetch(self, tests):
+        return dict((test, float(value)) for test, value in durations.hmget(self.redis, self.key, tests).items())
+
+    def record(self, results):
+        """Updates the scores from the {test: failed} results of a build."""
+        if not results:
+            return
+        scores = self.fetch(results)
+        pipeline = self.redis.pipeline(transaction=False)
+        for test, failed in results.items():
+            score = scores.get(test, 0.0) * self.decay + (1 if failed else 0)
+            if score >= MIN_SCORE:
+                pipeline.hset(self.key, test, '{:.3f}'.format(score))
+            elif test in scores:
+                pipeline.hdel(self.key, test)
+        pipeline.execute()
+
+    def likely_first(self, tests, scores=None):
+        """Moves the tests with a score first, highest first, the others keep their order."""
+        tests = list(tests)
+        if scores is None:
+            scores = self.fetch(tests)
+        return sorted(tests, key=lambda test: scores.get(test, 0.0), reverse=True)
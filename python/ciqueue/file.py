@@ -1,8 +1,36 @@
 from ciqueue import static
 
 
+def read_lines(path):
+    """Yields the lines of a file one by one, without their line ending."""
+    with open(path) as test_file:
+        for line in test_file:
+            yield line[:-1] if line.endswith('\n') else line
+
+
+def count_lines(path):
+    count = 0
+    for _ in read_lines(path):
+        count += 1
+    return count
+
+
 class File(static.Static):
+    """Reads the tests from the file as they're needed, so only the requeued
+    ones are held in memory."""
 
     def __init__(self, path, **kwargs):
-        with open(path) as test_file:
-            super(File, self).__init__(test_file.read().splitlines(), **kwargs)
+        super(File, self).__init__((), **kwargs)
+        self.path = path
+        self.total = count_lines(path)
+        self._remaining = self.total
+        self._lines = read_lines(path)
+
+    def __len__(self):
+        return len(self.queue) + self._remaining
+
+    def _pop(self):
+        if self.queue:
+            return self.queue.popleft()
+        self._remaining -= 1
+        return next(self._lines)
@@ -5,11 +5,14 @@ py.test -p ciqueue.pytest --queue redis://<host>:6379?worker=<worker_id>&build=<
 """
 from __future__ import absolute_import
 from __future__ import print_function
-import zlib
+import signal
 from ciqueue._pytest import test_queue
 from ciqueue._pytest import outcomes
-import dill
+from ciqueue._pytest import collection_cache
+from ciqueue._pytest import reports
+from ciqueue._pytest import pool
 import pytest
+from _pytest import runner
 from _pytest import terminal
 
 # pylint: disable=too-few-public-methods
@@ -20,24 +23,32 @@ def pytest_addoption(parser):
     parser.addoption('--queue', metavar='queue_url',
                      type=str, help='The queue url',
                      required=True)
+    parser.addoption('--queue-report-format', choices=reports.FORMATS, default=reports.COMPACT,
+                     help='How failures are stored for ciqueue.pytest_report: the rendered '
+                          'reports (compact, default) or a pickle of the whole call (pickle)')
 
 
 class ItemIndex(object):
+    """The collected items by test name. Only the leader iterates over the names,
+    so the lookup dict is built the first time a worker asks for an item."""
 
     def __init__(self, items):
-        self.index = dict((test_queue.key_item(i), i) for i in items)
+        self.items = items
+        self.index = None
 
     def __len__(self):
-        return len(self.index)
+        return len(self.items)
 
     def __getitem__(self, key):
+        if self.index is None:
+            self.index = dict((test_queue.key_item(i), i) for i in self.items)
         return self.index[key]
 
     def __iter__(self):
-        return iter(self.index)
+        return (test_queue.key_item(i) for i in self.items)
 
     def keys(self):
-        return self.index.keys()
+        return list(self)
 
 
 class ItemList(object):
@@ -53,19 +64,31 @@ class ItemList(object):
         for test in self.queue:
             yield self.index[test]
 
+    def next_item(self):
+        """The item the queue will yield next when it already holds it, so that
+        pytest keeps the module and class fixtures it shares with the current one."""
+        test = self.queue.peek()
+        return self.index[test] if test is not None else None
+
 
 class RedisReporter(object):
 
-    def __init__(self, config, queue):
+    def __init__(self, config, queue, results=None):
         self.config = config
         self.queue = queue
-        self.redis = queue.redis
-        self.errors_key = queue.key('error-reports')
+        # Where a worker process of the pool sends its reports
+        self.results = results
         self.terminalreporter = config.pluginmanager.get_plugin('terminalreporter')
         if hasattr(self.terminalreporter, '_get_progress_information_message'):
             self.__replace_progress_message()
         self.terminalwriter = config.get_terminal_writer()
-        self.logxml = config._xml if hasattr(config, '_xml') else None  # pylint: disable=protected-access
+        # The final reports of the failed or skipped phases by nodeid, None
+        # when the worker stores pickled calls instead of compact reports
+        self.reports = None
+        if config.getoption('queue_report_format') == reports.COMPACT and reports.supports_compact(config):
+            self.reports = {}
+        # The item being torn down and its teardown call, until its report is logged
+        self.teardown = None
 
     def __replace_progress_message(self):  # pylint: disable=no-self-use
         def _get_progress(self):  # pylint: disable=unused-argument
@@ -73,21 +96,24 @@ class RedisReporter(object):
 
         terminal.TerminalReporter._get_progress_information_message = _get_progress  # pylint: disable=protected-access
 
-    def record(self, item):
-        # if the test passed, we remove it from the errors queue
-        # otherwise we add it
-        if hasattr(item, 'error_reports'):
-            self.redis.hset(
-                self.errors_key,
-                test_queue.key_item(item),
-                zlib.compress(dill.dumps(item.error_reports)))
-        else:
-            self.redis.hdel(self.errors_key, test_queue.key_item(item))
+    def record(self, item, test_failed):
+        """Acknowledge the test and store its error report in a single round trip.
+        Failures are only recorded if we were the first to acknowledge the test,
+        anything else replaces the stored report, or removes it if the test passed."""
+        error = ''
+        if self.reports is not None:
+            final_reports = self.reports.pop(item.nodeid, {})
+            if final_reports:
+                error = reports.encode(self.config, final_reports)
+        elif hasattr(item, 'error_reports'):
+            error = reports.encode_pickle(item.error_reports)
+        return self.queue.acknowledge(test_queue.key_item(item), error=error, always_record=not test_failed)
 
     def mark_as_skipped(self, call, item, msg):
         assert call.when == 'teardown'
 
         stats = self.terminalreporter.stats
+        logxml = getattr(self.config, '_xml', None)
 
         def clear_out_stats(key):
             if key in stats:
@@ -95,16 +121,16 @@ class RedisReporter(object):
                 for i in stats[key]:
                     if i.nodeid != item.nodeid:
                         new_stats.append(i)
-                    elif self.logxml:
+                    elif logxml:
                         xmlkey = 'failure' if key == 'failed' else key
-                        self.logxml.stats[xmlkey] -= 1
+                        logxml.stats[xmlkey] -= 1
                 stats[key] = new_stats
                 if not stats[key]:
                     del stats[key]
 
         # remove the failure/error from logxml
-        if self.logxml:
-            self.logxml.node_reporters_ordered[-1].nodes = []
+        if logxml:
+            logxml.node_reporters_ordered[-1].nodes = []
 
         # the call is converted to a skip
         call.excinfo = outcomes.skipped_excinfo(item, msg)
@@ -113,9 +139,12 @@ class RedisReporter(object):
         for key in ('passed', 'error', 'failed'):
             clear_out_stats(key)
 
+        if self.results:
+            self.results.discard(item.nodeid)
+
         # rollback the testsfailed number like it never happened
         item.session.testsfailed -= len([v for k, v in item.error_reports.items()
-                                         if not issubclass(v['excinfo'].type, outcomes.Skipped) and k != 'teardown'])
+                                         if not outcomes.skipped(v['excinfo']) and k != 'teardown'])
 
         # and clear out any state on the item like it never happened
         if hasattr(item, 'error_reports'):
@@ -126,9 +155,13 @@ class RedisReporter(object):
         """This function hooks into pytest's reporting of test results, and pushes a failed test's error report
         onto the redis queue. A test can fail in any of the 3 call stages: setup, test, or teardown.
         This is captured by pushing a dict of {call_state: error} for each failed test."""
+        if call.when == 'setup':
+            # A requeued test runs again on the same item
+            item.queue_duration = 0
+        item.queue_duration += call.stop - call.start
+
         if call.excinfo:
             payload = call.__dict__.copy()
-            payload['excinfo'] = outcomes.swap_in_serializable(payload['excinfo'])
 
             if not hasattr(item, 'error_reports'):
                 item.error_reports = {call.when: payload}
@@ -136,25 +169,100 @@ class RedisReporter(object):
                 item.error_reports[call.when] = payload
 
         if call.when == 'teardown':
-            test_name = test_queue.key_item(item)
-            test_failed = outcomes.failed(item)
-
-            # Only attempt to requeue if the test failed.
-            # The method will return `False` if the test couldn't be requeued
-            if test_failed and self.queue.requeue(test_name):
-                self.mark_as_skipped(call, item, "WILL_RETRY")
-                self.terminalwriter.write(' WILL_RETRY ', green=True)
-
-            # If the test was already acknowledged by another worker (we timed out)
-            # Then we only record it if it was successful.
-            elif self.queue.acknowledge(test_name) or not test_failed:
-                self.record(item)
-
-            # The test timed out and failed, mark it as skipped so that it doesn't
-            # fail the build
-            else:
-                self.mark_as_skipped(call, item, "TIMED OUT")
-                self.terminalwriter.write(' TIMED OUT ', green=True)
+            # The test is acknowledged once every plugin made its teardown report
+            self.teardown = (item, call)
+
+    def finish(self, report):
+        """Requeues or acknowledges the test whose teardown `report` is, turning
+        the report into a skip when the failure won't count."""
+        item, call = self.teardown
+        self.teardown = None
+        test_name = test_queue.key_item(item)
+        test_failed = outcomes.failed(item)
+        self.queue.record_duration(test_name, item.queue_duration)
+        self.queue.record_result(test_name, test_failed)
+
+        # Only attempt to requeue if the test failed.
+        # The method will return `False` if the test couldn't be requeued
+        if test_failed and self.queue.requeue(test_name):
+            if self.reports is not None:
+                self.reports.pop(item.nodeid, None)
+            self.skip(report, call, item, "WILL_RETRY")
+
+        # If the test was already acknowledged by another worker (we timed out)
+        # Then its failure isn't recorded, and we mark it as skipped so that it
+        # doesn't fail the build
+        elif not self.record(item, test_failed) and test_failed:
+            self.skip(report, call, item, "TIMED OUT")
+
+    def skip(self, report, call, item, msg):
+        self.mark_as_skipped(call, item, msg)
+        skipped = runner.pytest_runtest_makereport(item, call)
+        report.outcome, report.longrepr = skipped.outcome, skipped.longrepr
+        self.terminalwriter.write(' {} '.format(msg), green=True)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_logreport(self, report):
+        if self.reports is not None and (report.failed or report.skipped):
+            self.reports.setdefault(report.nodeid, {})[report.when] = report
+        if report.when == 'teardown':
+            self.finish(report)
+        if self.results:
+            self.results.add(report)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if hasattr(self.queue, 'stats'):
+            terminalreporter.write_sep('=', 'ciqueue stats')
+            for line in self.queue.stats.summary():
+                terminalreporter.write_line(line)
+
+    def pytest_sessionfinish(self):
+        # Don't exit with acknowledgements still waiting to be written.
+        self.queue.flush()
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection(session):
+    """Skips the collection when the collection cache knows the tests, or when
+    only the failed tests are retried. Their files are then collected as the
+    worker reserves their tests."""
+    if session.config.option.collectonly:
+        return None
+
+    failed_tests = test_queue.failed_tests(session.config.getoption('queue'))
+    if failed_tests is not None:
+        return skip_collection(session, list(collection_cache.by_file(failed_tests).items()),
+                               'collected {} failed items to retry')
+
+    cache = test_queue.collection_cache(session.config.getoption('queue'))
+    if not cache:
+        return None
+
+    redis, prefix = cache
+    key = '{}:{}'.format(prefix, collection_cache.fingerprint(session.config))
+    session.collection_cache = (redis, key)
+    files = collection_cache.load(redis, key)
+    if files is None:
+        return None
+    return skip_collection(session, files, 'collected {} items from the collection cache')
+
+
+def skip_collection(session, files, message):
+    session.cached_test_files = files
+    session.items = []
+    session.testscollected = sum(len(tests) for _, tests in files)
+    reporter = session.config.pluginmanager.get_plugin('terminalreporter')
+    if reporter and session.config.option.verbose >= 0:
+        reporter.write_line(message.format(session.testscollected))
+    return True
+
+
+def pytest_collection_finish(session):
+    # Store what a full collection found, not what a test file's collection finds
+    if hasattr(session, 'collection_cache') and not hasattr(session, 'cached_test_files') \
+            and not session.testsfailed:
+        redis, key = session.collection_cache
+        collection_cache.save(redis, key, [test_queue.key_item(item) for item in session.items])
 
 
 @pytest.hookimpl(tryfirst=True)
@@ -167,15 +275,47 @@ def pytest_runtestloop(session):
     if session.config.option.collectonly:
         return True
 
-    config = session.config
-    tests_index = ItemIndex(session.items)
-    queue = test_queue.build_queue(config.getoption('queue'), tests_index)
-    if queue.distributed:
-        config.pluginmanager.register(RedisReporter(config, queue))
-    session.items = ItemList(tests_index, queue)
+    if hasattr(session, 'cached_test_files'):
+        tests_index = collection_cache.LazyItemIndex(session, session.cached_test_files)
+    else:
+        tests_index = ItemIndex(session.items)
 
-    for item in session.items:
-        item.config.hook.pytest_runtest_protocol(item=item, nextitem=None)
-        if session.shouldstop:
-            raise session.Interrupted(session.shouldstop)
+    procs = test_queue.worker_procs(session.config.getoption('queue'))
+    if procs > 1:
+        pool.run(session, procs, lambda proc, results: run_queue(session, tests_index, proc, results))
+    else:
+        run_queue(session, tests_index)
     return True
+
+
+def run_queue(session, tests_index, proc=None, results=None):
+    """Runs the tests the queue gives us, and returns the queue."""
+    config = session.config
+    queue = test_queue.build_queue(config.getoption('queue'), tests_index, proc)
+    previous_sigterm = None
+    if queue.distributed:
+        config.pluginmanager.register(RedisReporter(config, queue, results))
+
+        # Treat SIGTERM (e.g. a preempted node) like a KeyboardInterrupt, so the
+        # session finishes, and our tests are released, before we exit.
+        def interrupt(signum, frame):  # pylint: disable=unused-argument
+            raise session.Interrupted("Received SIGTERM")
+
+        previous_sigterm = signal.signal(signal.SIGTERM, interrupt)
+    items = session.items = ItemList(tests_index, queue)
+
+    try:
+        for item in items:
+            item.config.hook.pytest_runtest_protocol(item=item, nextitem=items.next_item())
+            if session.shouldstop:
+                raise session.Interrupted(session.shouldstop)
+    except KeyboardInterrupt:
+        # Hand the test we were running back right away rather than
+        # letting it sit in the running set until it times out.
+        queue.release()
+        raise
+    finally:
+        # Past the loop there is nothing left to release
+        if queue.distributed:
+            signal.signal(signal.SIGTERM, previous_sigterm if previous_sigterm is not None else signal.SIG_DFL)
+    return queue
@@ -6,12 +6,10 @@ py.test -p ciqueue.pytest_report --queue redis://<host>:6379?build=<build_id>&re
 
 from __future__ import absolute_import
 from __future__ import print_function
-import zlib
-import dill
 import pytest
 from _pytest import runner
 from ciqueue._pytest import test_queue
-from ciqueue._pytest import outcomes
+from ciqueue._pytest import reports
 
 
 def pytest_addoption(parser):
@@ -19,46 +17,84 @@ def pytest_addoption(parser):
     parser.addoption('--queue', metavar='queue_url',
                      type=str, help='The queue url',
                      required=True)
+    parser.addoption('--queue-compact', action='store_true', default=False,
+                     help="Drop the lists of the tests each worker ran once the build is reported, "
+                          "only `retry=failed` works after that")
 
 
 def noop():
     pass
 
 
+# How many items' error reports are fetched per HMGET
+REPORTS_PER_FETCH = 100
+
+
+class ErrorReports(object):
+    """Fetches the error reports of the items as pytest reaches them, REPORTS_PER_FETCH
+    items at a time, so that only the compressed reports of one window are held."""
+
+    def __init__(self, queue, items):
+        self.queue = queue
+        self.items = items
+        self.start = self.end = 0
+        self.window = {}
+
+    def pop(self, item):
+        index = item.queue_report_index
+        if not self.start <= index < self.end:
+            self.fetch(index)
+        return self.window.pop(item.nodeid, None)
+
+    def fetch(self, start):
+        """Replaces the window with the reports of the items from `start` on."""
+        items = self.items[start:start + REPORTS_PER_FETCH]
+        payloads = self.queue.error_reports(test_queue.key_item(item) for item in items)
+        self.window = dict((item.nodeid, payload) for item, payload in zip(items, payloads) if payload)
+        self.start, self.end = start, start + len(items)
+
+
 @pytest.hookimpl(trylast=True)
-def pytest_collection_modifyitems(session, config, items):  # pylint: disable=unused-argument
+def pytest_collection_modifyitems(session, config, items):
     """this function hooks into pytest's list of tests to run, converts all of them into
-    noop's, and downloads the result of each test run from the redis queue. Test errors are
-    attached to each test's `error_reports` field."""
+    noop's, and downloads the result of each test run from the redis queue as it's reported."""
     session.queue = test_queue.build_queue(session.config.getoption('queue'))
     session.queue.wait_for_workers(master_timeout=300)
-    error_reports = {k.decode(): v
-                     for k, v
-                     in session.queue.redis.hgetall(session.queue.key('error-reports')).items()}
+    config.queue = session.queue
 
-    for item in items:
+    for index, item in enumerate(items):
         # mock out all test calls
         item.setup = noop
         item.runtest = noop
         item.teardown = noop
+        item.queue_report_index = index
+    config.error_reports = ErrorReports(session.queue, list(items))
+
 
-        # store the errors on setup/test/teardown to item.error_reports
-        key = test_queue.key_item(item)
-        if key in error_reports:
-            item.error_reports = dill.loads(zlib.decompress(error_reports[key]))
-            for _, call_dict in item.error_reports.items():
-                call_dict['excinfo'] = outcomes.swap_back_original(call_dict['excinfo'])
+def decode_error_reports(item):
+    """Fetches and decodes the errors on setup/test/teardown of the item. Compact
+    reports go to `item.queue_reports`, pickled calls to `item.error_reports`."""
+    payload = item.config.error_reports.pop(item)
+    if payload is None:
+        return
+    if reports.is_compact(payload):
+        item.queue_reports = reports.decode(item.config, payload)
+    else:
+        item.error_reports = reports.decode_pickle(payload)
 
 
-@pytest.hookimpl(tryfirst=True)
+@pytest.hookimpl(hookwrapper=True, tryfirst=True)
 def pytest_runtest_makereport(item, call):
     """This function hooks into pytest's reporting of test results, and replaces the
     result of each test's setup/runtest/teardown call with the result from the redis queue"""
 
     # ensure all errors should come off the error-reports queue
     call.excinfo = None
-    if hasattr(item, 'error_reports') and call.when in item.error_reports:
-        call.__dict__ = item.error_reports[call.when]
+    if call.when == 'setup':
+        decode_error_reports(item)
+    error_reports = getattr(item, 'error_reports', {})
+    if call.when in error_reports:
+        call.__dict__ = error_reports[call.when]
 
         # This is needed to change the location of the failure
         # to point to the item definition, otherwise it will display
@@ -66,3 +102,33 @@ def pytest_runtest_makereport(item, call):
         # https://github.com/pytest-dev/pytest/blob/master/_pytest/skipping.py#L263-L269
         if call.excinfo and call.excinfo.type == runner.Skipped:
             item._evalskip = True  # pylint: disable=protected-access
+
+    outcome = yield
+
+    # Compact reports are the final ones from the worker, they
+    # replace whatever other plugins made of the noop call
+    queue_reports = getattr(item, 'queue_reports', {})
+    if call.when in queue_reports:
+        outcome.force_result(queue_reports[call.when])
+
+    # Only one test's reports are decoded at a time
+    if call.when == 'teardown':
+        for attribute in ('error_reports', 'queue_reports'):
+            if hasattr(item, attribute):
+                delattr(item, attribute)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    """Shows the stats of every worker of the build, merged."""
+    if not hasattr(config, 'queue'):
+        return
+    build_stats = config.queue.build_stats()
+    if build_stats.timings or build_stats.counters:
+        terminalreporter.write_sep('=', 'ciqueue build stats')
+        for line in build_stats.summary():
+            terminalreporter.write_line(line)
+
+
+def pytest_unconfigure(config):
+    if hasattr(config, 'queue') and config.getoption('queue_compact'):
+        config.queue.compact()
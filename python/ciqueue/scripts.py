@@ -0,0 +1,112 @@
+"""
+The Lua scripts of the queue, read once per process when this module is imported.
+
+A call is a single EVALSHA, including in pipelines, where redis-py would
+otherwise check the script cache before every execution. When the server
+answers NOSCRIPT (the first worker of a fresh server, or after a restart or a
+SCRIPT FLUSH), every script is loaded in a single round trip and the call is
+retried once.
+"""
+
+import os
+import re
+import hashlib
+import redis
+
+try:
+    from redis.cluster import RedisCluster
+except ImportError:  # redis-py < 4.1
+    RedisCluster = None
+
+
+def scripts_dir():
+    path = os.path.join(os.path.dirname(__file__), '../../redis')
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(__file__), 'redis')
+    return path
+
+
+def read_script(script_name):
+    with open(os.path.join(scripts_dir(), script_name + '.lua')) as script_file:
+        # Same `-- @include <name>` directive as the Ruby implementation
+        return re.sub(r'^-- @include (\S+)$',
+                      lambda match: read_script(match.group(1)),
+                      script_file.read(),
+                      flags=re.MULTILINE)
+
+
+class Script(object):
+    """Called like redis-py's scripts: `script(keys=[...], args=[...], client=redis)`."""
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def __call__(self, keys=None, args=None, client=None):
+        try:
+            return self.send(client, keys, args)
+        except redis.exceptions.NoScriptError:
+            load(client)
+            return self.send(client, keys, args)
+
+    def send(self, client, keys=None, args=None):
+        keys = keys or []
+        # Cluster pipelines don't have an evalsha method
+        return client.execute_command('EVALSHA', self.sha, len(keys), *(keys + (args or [])))
+
+
+def _read_scripts():
+    names = sorted(os.path.splitext(filename)[0] for filename in os.listdir(scripts_dir())
+                   if filename.endswith('.lua') and not filename.startswith('_'))
+    return dict((name, Script(name, read_script(name))) for name in names)
+
+
+SCRIPTS = _read_scripts()
+
+
+def is_cluster(client):
+    return RedisCluster is not None and isinstance(client, RedisCluster)
+
+
+def transaction(client):
+    """A MULTI/EXEC pipeline, or a plain one on a cluster, where redis-py only supports
+    transactions since 6.1. The keys of a build share a slot, so a cluster pipeline still
+    sends them to one node, which runs the commands in order."""
+    return client.pipeline(transaction=not is_cluster(client))
+
+
+def load(client):
+    """Loads every script on the server of `client`, or on every primary of a cluster."""
+    if is_cluster(client):
+        for script in SCRIPTS.values():
+            client.script_load(script.source)
+        return
+    pipeline = client.pipeline(transaction=False)
+    for script in SCRIPTS.values():
+        pipeline.script_load(script.source)
+    pipeline.execute()
+
+
+def _send(client, calls):
+    pipeline = client.pipeline(transaction=False)
+    for script, keys, args in calls:
+        script.send(pipeline, keys, args)
+    return pipeline.execute(raise_on_error=False)
+
+
+def execute(client, calls):
+    """Sends the (script, keys, args) calls in a single pipeline. The calls the server
+    answers NOSCRIPT to are retried once, after loading the scripts, and the first
+    error is raised."""
+    results = _send(client, calls)
+    missing = [index for index, result in enumerate(results)
+               if isinstance(result, redis.exceptions.NoScriptError)]
+    if missing:
+        load(client)
+        for index, result in zip(missing, _send(client, [calls[index] for index in missing])):
+            results[index] = result
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
@@ -1,3 +1,4 @@
+import collections
 import math
 
 
@@ -5,30 +6,56 @@ class Static(object):
     distributed = False
 
     def __init__(self, tests, max_requeues=0, requeue_tolerance=0):
-        self.queue = tests
+        self.queue = collections.deque(tests)
         self.progress = 0
-        self.total = len(tests)
+        self.total = len(self.queue)
         self.max_requeues = max_requeues
-        self.global_max_requeues = math.ceil(requeue_tolerance * self.total)
+        self.requeue_tolerance = requeue_tolerance
         self.requeues = {}
+        self.requeue_count = 0
+
+    @property
+    def global_max_requeues(self):
+        return math.ceil(self.requeue_tolerance * self.total)
 
     def __len__(self):
         return len(self.queue)
 
     def __iter__(self):
-        while self.queue:
-            yield self.queue.pop(0)
+        while len(self):
+            yield self._pop()
             self.progress += 1
 
-    def acknowledge(self, test):  # pylint: disable=no-self-use,unused-argument
+    def _pop(self):
+        return self.queue.popleft()
+
+    def peek(self):  # pylint: disable=no-self-use
+        # Requeued tests are inserted at the head of the queue after the
+        # current test is torn down, so the next test can't be known yet.
+        return None
+
+    def flush(self):  # pylint: disable=no-self-use
+        pass
+
+    def release(self):  # pylint: disable=no-self-use
+        pass
+
+    def record_duration(self, test, duration):  # pylint: disable=no-self-use,unused-argument
+        pass
+
+    def record_result(self, test, failed):  # pylint: disable=no-self-use,unused-argument
+        pass
+
+    def acknowledge(self, test, error='', always_record=False):  # pylint: disable=no-self-use,unused-argument
         return True
 
     def requeue(self, test):
         if self.requeues.get(test, 0) >= self.max_requeues:
             return False
-        if sum(self.requeues.values()) >= self.global_max_requeues:
+        if self.requeue_count >= self.global_max_requeues:
             return False
 
         self.requeues[test] = self.requeues.get(test, 0) + 1
-        self.queue.insert(0, test)
+        self.requeue_count += 1
+        self.queue.appendleft(test)
         return True
@@ -0,0 +1,100 @@
+"""
+Timing histograms and counters collected by the workers, which they publish
+to the `build:<id>:stats` hash so that they can be aggregated across workers.
+"""
+
+import collections
+import contextlib
+import json
+import math
+import time
+
+
+class Histogram(object):
+    """Durations in power of two buckets of microseconds, bucket `i` counts
+    the durations from 2^(i-1) (excluded) to 2^i (included) microseconds."""
+
+    def __init__(self, count=0, total=0.0, maximum=0.0, buckets=None):
+        self.count = count
+        self.total = total
+        self.maximum = maximum
+        self.buckets = collections.Counter(dict((int(i), n) for i, n in (buckets or {}).items()))
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        self.buckets[max(int(math.ceil(math.log(max(seconds * 1e6, 1), 2))), 0)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+        self.buckets.update(other.buckets)
+
+    def percentile(self, percent):
+        """The upper bound, in seconds, of the bucket holding the percentile."""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= self.count * percent / 100.0:
+                return min(2 ** bucket / 1e6, self.maximum)
+        return 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'maximum': self.maximum,
+                'buckets': dict((str(i), n) for i, n in self.buckets.items())}
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.timings = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name].add(time.time() - start)
+
+    def incr(self, name, count=1):
+        self.counters[name] += count
+
+    def merge(self, other):
+        for name, histogram in other.timings.items():
+            self.timings[name].merge(histogram)
+        self.counters.update(other.counters)
+
+    def dumps(self):
+        return json.dumps({
+            'timings': dict((name, h.to_dict()) for name, h in self.timings.items()),
+            'counters': dict(self.counters),
+        })
+
+    @classmethod
+    def loads(cls, payload):
+        data = json.loads(payload)
+        stats = cls()
+        for name, histogram in data['timings'].items():
+            stats.timings[name] = Histogram(**histogram)
+        stats.counters.update(data['counters'])
+        return stats
+
+    def summary(self):
+        """Returns the lines of a table of the timings, followed by the counters."""
+        def seconds(value):
+            return '{:.1f}ms'.format(value * 1000) if value < 1 else '{:.2f}s'.format(value)
+
+        lines = ['{:<24}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+            '', 'count', 'total', 'mean', 'p50', 'p95', 'max')]
+        for name, histogram in sorted(self.timings.items()):
+            lines.append('{:<24}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+                name, histogram.count, seconds(histogram.total), seconds(histogram.total / histogram.count),
+                seconds(histogram.percentile(50)), seconds(histogram.percentile(95)),
+                seconds(histogram.maximum)))
+        if self.counters:
+            lines.append(', '.join('{}: {}'.format(name, count) for name, count in sorted(self.counters.items())))
+        return lines
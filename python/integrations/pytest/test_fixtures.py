@@ -0,0 +1,22 @@
+import pytest
+
+SETUPS = []
+
+
+@pytest.fixture(scope='module')
+def connection():
+    SETUPS.append('connection')
+    yield
+
+
+class TestFixtures(object):
+
+    def test_first(self, connection):  # pylint: disable=unused-argument,no-self-use
+        pass
+
+    def test_second(self, connection):  # pylint: disable=unused-argument,no-self-use
+        pass
+
+
+def test_setup_once(connection):  # pylint: disable=unused-argument
+    assert SETUPS == ['connection']
@@ -0,0 +1,44 @@
+import os
+import pytest
+from redis import cluster
+from ciqueue import distributed
+from ciqueue._pytest import test_queue
+from tests import test_distributed
+
+# e.g. redis+cluster://localhost:7000, any node of a cluster with several primaries
+CLUSTER_URL = os.getenv('REDIS_CLUSTER_URL')
+
+
+@pytest.mark.skipif(not CLUSTER_URL, reason='REDIS_CLUSTER_URL is not set')
+class TestCluster(test_distributed.TestDistributed):
+    """The distributed tests, against a Redis Cluster."""
+
+    @staticmethod
+    def redis_client():
+        return cluster.RedisCluster.from_url(CLUSTER_URL.replace('+cluster', '', 1))
+
+    def test_build_queue(self):
+        queue = test_queue.build_queue(CLUSTER_URL + '?worker=1&build=42&timeout=5', self.TEST_LIST)
+        assert isinstance(queue, distributed.Worker)
+        assert isinstance(queue.redis, cluster.RedisCluster)
+        assert self.work_off(queue) == self.TEST_LIST
+
+        # Every key of the build is in the same slot
+        keys = [key.decode() for key in self._redis.scan_iter('build:*')]
+        assert len(keys) > 5
+        assert len(set(self._redis.keyslot(key) for key in keys)) == 1
+
+    def test_no_transactions(self, monkeypatch):
+        pipeline = cluster.RedisCluster.pipeline
+
+        def no_transaction_pipeline(client, transaction=None, shard_hint=None):
+            # Like redis-py before 6.1
+            if transaction:
+                raise cluster.RedisClusterException("transaction is deprecated in cluster mode")
+            return pipeline(client, transaction, shard_hint)
+
+        monkeypatch.setattr(cluster.RedisCluster, 'pipeline', no_transaction_pipeline)
+        queue = test_queue.build_queue(CLUSTER_URL + '?worker=1&build=42&timeout=5', self.TEST_LIST)
+        assert len(queue) == len(self.TEST_LIST)
+        assert self.work_off(queue) == self.TEST_LIST
+        assert not queue
@@ -1,28 +1,46 @@
 import os
+import signal
+import time
+import multiprocessing
+import threading
 import pytest
 import redis
 from ciqueue import distributed
 from tests import shared
 
 
+def reserve_lost(queue):
+    """The [test, lease] of the lost test `queue` reclaims, if any, without taking one off the queue."""
+    result = queue._try_to_reserve_test(batch_size=0)  # pylint: disable=protected-access
+    return result[1:] if result else None
+
+
 class TestDistributed(shared.QueueImplementation):
     _redis = None
 
     def setup_method(self, _):
-        self._redis = redis.StrictRedis(
+        self._redis = self.redis_client()
+        self._redis.flushdb()
+
+    @staticmethod
+    def redis_client():
+        return redis.StrictRedis(
             host=os.getenv('REDIS_HOST')
         )
-        self._redis.flushdb()
 
     def build_queue(self, worker_id=1, **kwargs):  # pylint: disable=arguments-differ
+        options = dict(
+            timeout=0.2,
+            max_requeues=1,
+            requeue_tolerance=0.1,
+        )
+        options.update(kwargs)
         return distributed.Worker(
             self.TEST_LIST,
             redis=self._redis,
             worker_id=str(worker_id),
             build_id=42,
-            timeout=0.2,
-            max_requeues=1,
-            requeue_tolerance=0.1,
+            **options
         )
 
     def build_supervisor(self):
@@ -40,6 +58,32 @@ class TestDistributed(shared.QueueImplementation):
         retry_test_order = self.work_off(retry_queue)
         assert retry_test_order == initial_test_order
 
+    def test_build_keys_expire(self):
+        queue = self.build_queue(ttl=600)
+        for test in queue:
+            queue.acknowledge(test, error='failed' if test == self.TEST_LIST[0] else '')
+
+        keys = list(self._redis.scan_iter('build:*'))
+        assert queue.key('worker', 1, 'failed').encode() in keys
+        for key in keys:
+            assert 0 < self._redis.ttl(key) <= 600, key
+
+    def test_no_ttl(self):
+        queue = self.build_queue(ttl=0)
+        self.work_off(queue)
+        for key in self._redis.scan_iter('build:*'):
+            assert self._redis.ttl(key) == -1, key
+
+    def test_compact(self):
+        queue = self.build_queue()
+        for test in queue:
+            queue.acknowledge(test, error='failed' if test == self.TEST_LIST[0] else '')
+
+        self.build_supervisor().compact()
+        assert not self._redis.exists(queue.key('worker', 1, 'queue'))
+        assert not self._redis.exists(queue.key('worker', 1, 'owned'))
+        assert list(queue.retry_queue(failed_only=True)) == [self.TEST_LIST[0]]
+
     def test_shutdown(self):
         queue = self.build_queue()
         count = 0
@@ -66,3 +110,379 @@ class TestDistributed(shared.QueueImplementation):
         self.build_queue(1)
 
         assert supervisor.wait_for_master(timeout=0)
+
+    def test_batch_reservation(self):
+        queue = self.build_queue(options=distributed.Options(batch_size=3))
+        test_order = []
+
+        for test in queue:
+            if not test_order:
+                assert self._redis.zcard(queue.key('running')) == 3
+            test_order.append(test)
+            assert queue.acknowledge(test) is True
+
+        assert test_order == self.TEST_LIST
+        assert len(queue) == 0
+
+    def test_shutdown_gives_back_reserved_tests(self):
+        queue = self.build_queue(options=distributed.Options(batch_size=3))
+
+        for test in queue:
+            queue.acknowledge(test)
+            queue.shutdown()
+
+        assert self._redis.zcard(queue.key('running')) == 0
+        assert self._redis.llen(queue.key('worker', 1, 'queue')) == 1
+        assert len(queue) == len(self.TEST_LIST) - 1
+
+        second_queue = self.build_queue(2)
+        assert self.work_off(second_queue) == self.TEST_LIST[1:]
+
+    def test_acknowledge_records_error(self):
+        queue = self.build_queue()
+        errors_key = queue.key('error-reports')
+        tests = iter(queue)
+
+        failed = next(tests)
+        assert queue.acknowledge(failed, error='boom') is True
+        assert self._redis.hget(errors_key, failed) == b'boom'
+
+        # a failure from a worker that wasn't first to acknowledge is dropped
+        assert queue.acknowledge(failed, error='late') is False
+        assert self._redis.hget(errors_key, failed) == b'boom'
+
+        # but a later success clears it
+        assert queue.acknowledge(failed, always_record=True) is False
+        assert self._redis.hget(errors_key, failed) is None
+
+    def test_write_behind(self):
+        queue = self.build_queue(options=distributed.Options(write_behind=2))
+        test_order = []
+
+        for test in queue:
+            test_order.append(test)
+            assert queue.acknowledge(test, always_record=True) is None
+
+        assert test_order == self.TEST_LIST
+        assert self._redis.scard(queue.key('processed')) == len(self.TEST_LIST)
+        assert len(queue) == 0
+
+    def test_write_behind_waits_for_failures(self):
+        queue = self.build_queue(options=distributed.Options(write_behind=2))
+
+        for test in queue:
+            assert queue.acknowledge(test, error='boom') is True
+            assert self._redis.hget(queue.key('error-reports'), test) == b'boom'
+
+    def test_write_behind_retries(self, monkeypatch):
+        execute = distributed.scripts.execute
+        failures = []
+
+        def flaky_execute(client, calls):
+            if threading.current_thread().name == 'ciqueue-write-behind' and not failures:
+                failures.append(calls)
+                raise redis.ConnectionError('blip')
+            return execute(client, calls)
+
+        monkeypatch.setattr(distributed.scripts, 'execute', flaky_execute)
+        queue = self.build_queue(options=distributed.Options(write_behind=2))
+        for test in queue:
+            queue.acknowledge(test, always_record=True)
+        assert failures
+        assert self._redis.scard(queue.key('processed')) == len(self.TEST_LIST)
+        # Rather than left running until they time out
+        assert queue.stats.counters['reclaimed'] == 0
+
+    def test_write_behind_raises_errors(self, monkeypatch):
+        def broken_execute(client, calls):  # pylint: disable=unused-argument
+            raise ValueError('broken')
+
+        monkeypatch.setattr(distributed.WriteBehind, 'RETRY_DELAY', 0)
+        monkeypatch.setattr(distributed.scripts, 'execute', broken_execute)
+        queue = self.build_queue(options=distributed.Options(write_behind=1))
+        # The thread keeps taking writes, so acknowledge doesn't block
+        for test in self.TEST_LIST:
+            queue.acknowledge(test, always_record=True)
+        with pytest.raises(ValueError):
+            queue.flush()
+        # Only once
+        queue.flush()
+
+    def test_heartbeat_keeps_running_tests(self):
+        queue = self.build_queue(options=distributed.Options(heartbeat_interval=0.05))
+        second_queue = self.build_queue(2)
+
+        for test in queue:
+            time.sleep(0.5)
+            assert reserve_lost(second_queue) is None
+            queue.acknowledge(test)
+            queue.shutdown()
+
+    def test_killed_worker_tests_are_reclaimed(self):
+        def run_worker():
+            self._redis = self.redis_client()
+            for _ in self.build_queue(options=distributed.Options(heartbeat_interval=0.05)):
+                time.sleep(60)
+
+        worker = multiprocessing.get_context('fork').Process(target=run_worker)
+        worker.start()
+        try:
+            while not self._redis.zcard('build:{42}:running'):
+                time.sleep(0.01)
+
+            # The worker is alive and beating, so its test isn't lost
+            queue = self.build_queue(2)
+            time.sleep(0.5)
+            assert reserve_lost(queue) is None
+        finally:
+            os.kill(worker.pid, signal.SIGKILL)
+            worker.join()
+
+        time.sleep(0.3)
+        lost = reserve_lost(queue)
+        assert lost[0].decode() == self.TEST_LIST[0]
+
+    def test_release(self):
+        queue = self.build_queue(options=distributed.Options(batch_size=3))
+        second_queue = self.build_queue(2)
+
+        for test in queue:
+            queue.release()
+            lost = reserve_lost(second_queue)
+            assert lost[0].decode() == test
+
+        assert self._redis.llen(queue.key('queue')) == len(self.TEST_LIST) - 1
+
+    def test_owned_tests_index(self):
+        queue = self.build_queue()
+        second_queue = self.build_queue(2)
+
+        for test in queue:
+            assert self._redis.smembers(queue.key('worker', 1, 'owned')) == {test.encode()}
+            time.sleep(0.3)
+            assert second_queue._reserve() == test  # pylint: disable=protected-access
+            assert not self._redis.smembers(queue.key('worker', 1, 'owned'))
+            assert self._redis.smembers(queue.key('worker', 2, 'owned')) == {test.encode()}
+
+            second_queue.acknowledge(test)
+            assert not self._redis.smembers(queue.key('worker', 2, 'owned'))
+            queue.shutdown()
+
+    def test_reserve_reclaims_lost_tests_first(self):
+        queue = self.build_queue()
+        second_queue = self.build_queue(2)
+        queue._reserve()  # pylint: disable=protected-access
+        time.sleep(0.3)
+
+        assert second_queue._reserve() == self.TEST_LIST[0]  # pylint: disable=protected-access
+        assert second_queue._reserve() == self.TEST_LIST[1]  # pylint: disable=protected-access
+        assert second_queue.stats.counters['reclaimed'] == 1
+        assert second_queue.stats.counters['reserved'] == 2
+        # A single script call per reservation
+        assert second_queue.stats.timings['script:reserve'].count == 2
+
+    def test_requeue_offset(self):
+        queue = self.build_queue()
+        test_order = []
+
+        for test in queue:
+            if not test_order:
+                assert queue.requeue(test, offset=1)
+            else:
+                queue.acknowledge(test)
+            test_order.append(test)
+
+        expected = self.TEST_LIST[:3] + [self.TEST_LIST[0], self.TEST_LIST[3]]
+        assert test_order == expected
+
+    def test_intern_ids(self):
+        queue = self.build_queue(intern_ids=True)
+        # Workers find out from the leader's keys
+        second_queue = self.build_queue(2)
+        assert self._redis.lrange(queue.key('queue'), 0, -1) == [b'3', b'2', b'1', b'0']
+
+        test_order = []
+        for test in second_queue:
+            test_order.append(test)
+            second_queue.acknowledge(test, error='boom')
+        assert test_order == self.TEST_LIST
+
+        supervisor = self.build_supervisor()
+        error_reports = self._redis.hkeys(queue.key('error-reports'))
+        assert sorted(supervisor.test_name(k.decode()) for k in error_reports) == sorted(self.TEST_LIST)
+
+    def test_durations(self):
+        queue = self.build_queue(options=distributed.Options(durations_key='test-durations'))
+        for test in queue:
+            queue.record_duration(test, float(self.TEST_LIST.index(test)))
+            queue.acknowledge(test)
+        assert self._redis.hget('test-durations', self.TEST_LIST[3]) == b'3.000'
+
+        self._redis.delete(*self._redis.scan_iter('build:*'))
+        queue = self.build_queue(options=distributed.Options(durations_key='test-durations'))
+        queue.record_duration(self.TEST_LIST[3], 5)
+        queue.flush()
+        assert self._redis.hget('test-durations', self.TEST_LIST[3]) == b'3.000,5.000'
+
+        self._redis.delete(*self._redis.scan_iter('build:*'))
+        self._redis.hdel('test-durations', self.TEST_LIST[0])
+        queue = self.build_queue(options=distributed.Options(durations_key='test-durations', default_duration=2.5))
+        test_order = []
+        for test in queue:
+            test_order.append(test)
+            queue.acknowledge(test)
+        assert test_order == [self.TEST_LIST[i] for i in (3, 0, 2, 1)]
+
+    def test_timeout_from_durations(self, monkeypatch):
+        monkeypatch.setattr(distributed.Worker, 'MIN_TEST_TIMEOUT', 0.1)
+        for test in self.TEST_LIST[:2]:
+            self._redis.hset('test-durations', test, '0.010,0.020')
+        options = distributed.Options(durations_key='test-durations', timeout_multiplier=3, batch_size=2)
+        queue = self.build_queue(timeout=60, options=options)
+        assert queue._reserve() == self.TEST_LIST[0]  # pylint: disable=protected-access
+
+        # Only the running test gets the shorter timeout, the one
+        # buffered behind it keeps the global timeout until its turn
+        second_queue = self.build_queue(2, timeout=60)
+        assert reserve_lost(second_queue) is None
+        time.sleep(0.2)
+        lost = reserve_lost(second_queue)
+        assert [test.decode() for test in lost[::2]] == [self.TEST_LIST[0]]
+        assert reserve_lost(second_queue) is None
+        second_queue.acknowledge(self.TEST_LIST[0])
+
+        # Heartbeats don't shorten it either
+        queue.heartbeat()
+        time.sleep(0.2)
+        assert reserve_lost(second_queue) is None
+
+    def test_failures_first(self):
+        def run_build(failing):
+            queue = self.build_queue(options=distributed.Options(failures_key='test-failures'))
+            test_order = []
+            for test in queue:
+                test_order.append(test)
+                queue.record_result(test, test == failing)
+                queue.acknowledge(test)
+            self._redis.delete(*self._redis.scan_iter('build:*'))
+            return test_order
+
+        assert run_build(self.TEST_LIST[2]) == self.TEST_LIST
+        assert run_build(self.TEST_LIST[3]) == [self.TEST_LIST[i] for i in (2, 0, 1, 3)]
+        assert run_build(None) == [self.TEST_LIST[i] for i in (3, 2, 0, 1)]
+        assert self._redis.hgetall('test-failures') == {
+            self.TEST_LIST[2].encode(): b'0.250',
+            self.TEST_LIST[3].encode(): b'0.500',
+        }
+
+    def test_scripts_reloaded_after_flush(self):
+        queue = self.build_queue(options=distributed.Options(write_behind=10, heartbeat_interval=60))
+        test_order = []
+        for test in queue:
+            self._redis.script_flush()
+            queue.heartbeat()
+            self._redis.script_flush()
+            queue.acknowledge(test, always_record=True)
+            queue.flush()
+            test_order.append(test)
+        assert test_order == self.TEST_LIST
+        assert self._redis.scard(queue.key('processed')) == len(self.TEST_LIST)
+
+    def test_group_by_module(self):
+        tests = ['a.py::test_1', 'b.py::TestB::test_1', 'a.py::test_2', 'b.py::TestB::test_2', 'b.py::test_3']
+        options = distributed.Options(group_by='module')
+        queue = distributed.Worker(tests, redis=self._redis, worker_id='1', build_id=42,
+                                   timeout=0.2, options=options)
+        second_queue = distributed.Worker(tests, redis=self._redis, worker_id='2', build_id=42,
+                                          timeout=0.2, options=options)
+
+        test_order = []
+        for test in queue:
+            test_order.append((test, queue.peek()))
+            if len(test_order) == 1:
+                assert self._redis.zcard(queue.key('running')) == 2
+                assert second_queue._reserve() == 'b.py::TestB::test_1'  # pylint: disable=protected-access
+                assert second_queue.peek() == 'b.py::TestB::test_2'
+                assert list(second_queue._reserved) == tests[3:]  # pylint: disable=protected-access
+                for other in tests[1::2] + tests[4:]:
+                    second_queue.acknowledge(other)
+            queue.acknowledge(test)
+        assert test_order == [('a.py::test_1', 'a.py::test_2'), ('a.py::test_2', None)]
+
+    def test_group_ends_at_deferred_test(self):
+        tests = ['x.py::test_1', 'a.py::test_1', 'a.py::test_2', 'a.py::test_3']
+        args = dict(redis=self._redis, build_id=42, timeout=0.2, max_requeues=1, requeue_tolerance=1,
+                    options=distributed.Options(group_by='module'))
+        queue = distributed.Worker(tests, worker_id='1', **args)
+        second_queue = distributed.Worker(tests, worker_id='2', **args)
+        assert second_queue._reserve() == 'x.py::test_1'  # pylint: disable=protected-access
+        assert second_queue.requeue('x.py::test_1', offset=1)
+
+        # x.py::test_1 is due after a.py::test_2, so it isn't left behind the rest of a.py
+        assert queue._reserve() == 'a.py::test_1'  # pylint: disable=protected-access
+        assert list(queue._reserved) == ['a.py::test_2']  # pylint: disable=protected-access
+        queue.acknowledge('a.py::test_1')
+        assert queue._reserve() == 'a.py::test_2'  # pylint: disable=protected-access
+        queue.acknowledge('a.py::test_2')
+        assert queue._reserve() == 'x.py::test_1'  # pylint: disable=protected-access
+        assert queue._reserve() == 'a.py::test_3'  # pylint: disable=protected-access
+
+    def test_group_by_class(self):
+        tests = ['a.py::TestA::test_1', 'a.py::TestA::test_2', 'a.py::TestB::test_1', 'a.py::test_2[x::y]']
+        assert [len(group) for group in distributed.group_tests(tests, 'class')] == [2, 1, 1]
+        assert [len(group) for group in distributed.group_tests(tests, 'module')] == [4]
+
+    def test_idle_worker_waits_for_events(self):
+        queue = self.build_queue(timeout=10, requeue_tolerance=1)
+        second_queue = self.build_queue(2, timeout=10, requeue_tolerance=1)
+        second_queue.IDLE_WAIT = 30
+        for _ in self.TEST_LIST:
+            queue._reserve()  # pylint: disable=protected-access
+
+        test_order = []
+
+        def run():
+            for test in second_queue:
+                test_order.append((test, time.time()))
+                second_queue.acknowledge(test)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(0.2)
+        assert not test_order
+
+        requeued_at = time.time()
+        assert queue.requeue(self.TEST_LIST[0])
+        for test in self.TEST_LIST[1:]:
+            time.sleep(0.1)
+            queue.acknowledge(test)
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert [test for test, _ in test_order] == [self.TEST_LIST[0]]
+        assert test_order[0][1] - requeued_at < 1
+
+    def test_push_in_chunks(self, monkeypatch):
+        monkeypatch.setattr(distributed.Worker, 'PUSH_CHUNK_SIZE', 3)
+        monkeypatch.setattr(distributed.Worker, 'PUSH_BATCH_SIZE', 5)
+        queue = self.build_queue(intern_ids=True)
+        assert self._redis.lrange(queue.key('test-ids'), 0, -1) == [t.encode() for t in self.TEST_LIST]
+        assert self._redis.lrange(queue.key('queue'), 0, -1) == [b'3', b'2', b'1', b'0']
+
+        second_queue = self.build_queue(2, intern_ids=True)
+        test_order = []
+        for test in second_queue:
+            test_order.append(test)
+            second_queue.acknowledge(test)
+        assert test_order == self.TEST_LIST
+
+    def test_build_stats(self):
+        for worker_id in (1, 2):
+            queue = self.build_queue(worker_id)
+            for test in queue:
+                queue.acknowledge(test)
+
+        build_stats = self.build_supervisor().build_stats()
+        assert build_stats.counters['reserved'] == len(self.TEST_LIST)
+        assert build_stats.timings['script:acknowledge'].count == len(self.TEST_LIST)
+        assert build_stats.timings['script:reserve'].count >= len(self.TEST_LIST)
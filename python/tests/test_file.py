@@ -9,3 +9,22 @@ class TestFile(shared.QueueImplementation):
         with open(self.TEST_LIST_PATH, 'w+') as test_file:
             test_file.write("\n".join(self.TEST_LIST))
         return ciqueue.File(self.TEST_LIST_PATH, max_requeues=1, requeue_tolerance=0.1)
+
+    def test_line_endings(self):
+        with open(self.TEST_LIST_PATH, 'wb') as test_file:
+            test_file.write(b'ATest#test_foo\r\nATest#test_bar\nBTest#test_foo\n')
+        queue = ciqueue.File(self.TEST_LIST_PATH)
+        assert len(queue) == 3
+        assert self.work_off(queue) == ['ATest#test_foo', 'ATest#test_bar', 'BTest#test_foo']
+        assert len(queue) == 0
+
+    def test_requeue_while_streaming(self):
+        queue = self.build_queue()
+        test_order = []
+        for test in queue:
+            if len(test_order) == 2:
+                assert queue.requeue(test)
+                assert len(queue) == 2
+            queue.acknowledge(test)
+            test_order.append(test)
+        assert test_order == self.TEST_LIST[:3] + self.TEST_LIST[2:]
@@ -1,6 +1,8 @@
 import os
 import re
+import signal
 import subprocess
+import time
 import redis
 import pytest
 
@@ -43,13 +45,24 @@ class TestIntegration(object):
         expected_messages(check_output(report_cmd))
 
         # test that pytest_report only reports what's on the redis queue
-        self.redis.delete('build:foo:error-reports')
+        self.redis.delete('build:{foo}:error-reports')
         queue = "redis://localhost:6379/0?build=foo&retry=0"
         output = check_output(report_cmd)
         assert '= 11 passed, 1 xpassed in' in output, output
         assert ('integrations/pytest/test_all.py:27: message' not in output
                 and 'integrations/pytest/test_all.py:28: message' not in output), output
 
+    def test_intern_ids(self):
+        queue = "redis://localhost:6379/0?worker=0&build=foo&timeout=5&intern_ids=true"
+        cmd = "py.test -v -r a -p ciqueue.pytest --queue '{}' integrations/pytest/test_all.py; exit 0"\
+            .format(queue)
+        report_cmd = "py.test -v -r a -p ciqueue.pytest_report --queue '{}' integrations/pytest/test_all.py; exit 0"\
+            .format(queue)
+
+        expected_messages(check_output(cmd))
+        expected_messages(check_output(report_cmd))
+        assert self.redis.lindex('build:{foo}:test-ids', 0).startswith(b'integrations/pytest/test_all.py::')
+
     def test_retries_and_junit_xml(self, tmpdir):
         queue = ('redis://localhost:6379/0?worker=0&build=bar&retry=0&timeout=5'
                  '&max_requeues=1&requeue_tolerance=0.2'
@@ -80,6 +93,59 @@ class TestIntegration(object):
         assert xml.count('/skipped') == 1
         assert xml.count('/error') == 6
 
+    def test_report_fetches_reports_in_windows(self, tmpdir):
+        failures = 250
+        tmpdir.join('test_many.py').write(
+            "import pytest\n\n\n"
+            "@pytest.mark.parametrize('i', range({}))\n"
+            "def test_fail(i):\n"
+            "    assert i < 0\n".format(failures))
+        # The report must not keep any payload once the item is reported
+        tmpdir.join('conftest.py').write(
+            "import pytest\n\n\n"
+            "@pytest.hookimpl(hookwrapper=True)\n"
+            "def pytest_runtest_protocol(item):\n"
+            "    yield\n"
+            "    if hasattr(item.config, 'error_reports'):\n"
+            "        assert len(item.config.error_reports.window) < 100\n"
+            "        for attribute in ('queue_reports', 'error_reports'):\n"
+            "            assert not hasattr(item, attribute), item.nodeid\n")
+        queue = "redis://localhost:6379/0?worker=0&build=many&timeout=5"
+        check_output("py.test -p ciqueue.pytest --queue '{}' {}; exit 0".format(queue, tmpdir))
+
+        output = check_output("py.test -r f -p ciqueue.pytest_report --queue '{}' {}; exit 0".format(queue, tmpdir))
+        assert '= {} failed in'.format(failures) in output, output
+        failed = re.findall(r'^FAILED \S+::test_fail\[(\d+)\]', output, re.MULTILINE)
+        assert sorted(int(i) for i in failed) == list(range(failures)), output
+
+    def test_report_from_every_plugin(self, tmpdir):
+        tmpdir.join('test_properties.py').write(
+            "import datetime\n"
+            "import pytest\n\n\n"
+            "@pytest.fixture\n"
+            "def broken_teardown():\n"
+            "    yield\n"
+            "    raise RuntimeError('teardown failed')\n\n\n"
+            "def test_property(record_property, broken_teardown):\n"
+            "    record_property('when', datetime.datetime(2020, 1, 1))\n"
+            "    assert False\n")
+        tmpdir.join('conftest.py').write(
+            "import pytest\n\n\n"
+            "@pytest.hookimpl(hookwrapper=True)\n"
+            "def pytest_runtest_makereport(item, call):\n"
+            "    outcome = yield\n"
+            "    if call.when == 'teardown' and call.excinfo:\n"
+            "        outcome.get_result().sections.append(('plugin section', 'added by a plugin'))\n")
+        queue = "redis://localhost:6379/0?worker=0&build=properties&timeout=5"
+        output = check_output("py.test -p ciqueue.pytest --queue '{}' {}; exit 0".format(queue, tmpdir))
+        assert 'INTERNALERROR' not in output, output
+        assert '= 1 failed, 1 error in' in output, output
+
+        output = check_output("py.test -p ciqueue.pytest_report --queue '{}' {}; exit 0".format(queue, tmpdir))
+        assert '= 1 failed, 1 error in' in output, output
+        assert 'teardown failed' in output, output
+        assert 'added by a plugin' in output, output
+
     def test_flakey(self):
         queue = "redis://localhost:6379/0?worker=0&build=bar&timeout=5&max_requeues=1&requeue_tolerance=0.2"
         filename = 'test_flakey.py'
@@ -92,3 +158,160 @@ class TestIntegration(object):
 
         output = check_output(report_cmd)
         assert '= 1 passed in' in output, output
+
+    def test_requeued_test_duration(self, tmpdir):
+        tmpdir.join('test_slow_flakey.py').write(
+            "import time\n\n"
+            "runs = []\n\n\n"
+            "def test_slow_flakey():\n"
+            "    runs.append(1)\n"
+            "    time.sleep(0.5)\n"
+            "    assert len(runs) > 1\n")
+        queue = ("redis://localhost:6379/0?worker=0&build=bar&timeout=5&max_requeues=1&requeue_tolerance=1"
+                 "&durations_key=durations")
+        output = check_output("py.test -p ciqueue.pytest --queue '{}' {}; exit 0".format(queue, tmpdir))
+        assert '= 1 passed, 1 skipped in' in output, output
+
+        # The last run's duration, not the total of both runs
+        duration = float(self.redis.hget('durations', 'test_slow_flakey.py::test_slow_flakey'))
+        assert 0.5 <= duration < 0.9, duration
+
+    def test_sigterm_releases_running_test(self):
+        queue = "redis://localhost:6379/0?worker=0&build=baz&timeout=30"
+        worker = subprocess.Popen(
+            "exec py.test -p ciqueue.pytest --queue '{}' integrations/pytest/test_slow.py".format(queue),
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        while not self.redis.zcard('build:{baz}:running'):
+            assert worker.poll() is None, worker.stdout.read()
+            time.sleep(0.1)
+
+        worker.send_signal(signal.SIGTERM)
+        output = worker.communicate()[0].decode()
+        assert 'Received SIGTERM' in output, output
+        assert self.redis.zscore('build:{baz}:running', 'integrations/pytest/test_slow.py::test_slow') == 0, output
+        assert not self.redis.hlen('build:{baz}:leases')
+
+    def test_sigterm_stops_procs(self):
+        queue = "redis://localhost:6379/0?worker=0&build=baz&timeout=30&procs=2"
+        worker = subprocess.Popen(
+            "exec py.test -p ciqueue.pytest --queue '{}' integrations/pytest/test_slow.py".format(queue),
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        while not self.redis.zcard('build:{baz}:running'):
+            assert worker.poll() is None, worker.stdout.read()
+            time.sleep(0.1)
+
+        # Only the parent is signaled, the workers must not outlive it
+        worker.send_signal(signal.SIGTERM)
+        output = worker.communicate(timeout=30)[0].decode()
+        assert 'Received SIGTERM' in output, output
+        assert self.redis.zscore('build:{baz}:running', 'integrations/pytest/test_slow.py::test_slow') == 0, output
+        assert not self.redis.hlen('build:{baz}:leases')
+
+    def test_group_by_module(self):
+        queue = "redis://localhost:6379/0?worker=0&build=foo&timeout=5&group_by=module"
+        cmd = "py.test -v -p ciqueue.pytest --queue '{}' integrations/pytest/test_fixtures.py; exit 0".format(queue)
+        output = check_output(cmd)
+        assert '3 passed' in output, output
+
+    def test_report_formats(self):
+        for report_format in ('compact', 'pickle'):
+            queue = "redis://localhost:6379/0?worker=0&build={}&timeout=5".format(report_format)
+            cmd = ("py.test -v -r a -p ciqueue.pytest --queue '{}' --queue-report-format={} "
+                   "integrations/pytest/test_all.py; exit 0").format(queue, report_format)
+            report_cmd = ("py.test -v -r a -p ciqueue.pytest_report --queue '{}' "
+                          "integrations/pytest/test_all.py; exit 0").format(queue)
+
+            expected_messages(check_output(cmd))
+            output = check_output(report_cmd)
+            expected_messages(output)
+            if report_format == 'compact':
+                # Rendered on the worker, so the skip points at the test
+                assert 'integrations/pytest/test_all.py:28: skipping test message' in output, output
+
+            error_reports = self.redis.hvals('build:{{{}}}:error-reports'.format(report_format))
+            assert all(report.startswith(b'\x00ciqueue:1:') == (report_format == 'compact')
+                       for report in error_reports)
+
+    def test_collection_cache(self):
+        for build in ('cold', 'warm'):
+            queue = "redis://localhost:6379/0?worker=0&build={}&timeout=5&collection_cache_key=collection"\
+                .format(build)
+            cmd = "py.test -v -r a -p ciqueue.pytest --queue '{}' integrations/pytest/test_all.py; exit 0"\
+                .format(queue)
+            output = check_output(cmd)
+            expected_messages(output)
+            assert ('from the collection cache' in output) == (build == 'warm'), output
+        assert len(self.redis.keys('collection:*')) == 1
+
+    def test_collection_cache_deselect(self, tmpdir):
+        tmpdir.join('test_x.py').write("def test_a():\n    pass\n\n\ndef test_b():\n    pass\n")
+        cmd = ("py.test -p ciqueue.pytest "
+               "--queue 'redis://localhost:6379/0?worker=0&build={}&timeout=5&collection_cache_key=collection' {} {}; "
+               "exit 0")
+        output = check_output(cmd.format('deselect', '--deselect test_x.py::test_b', tmpdir))
+        assert '= 1 passed, 1 deselected in' in output, output
+
+        output = check_output(cmd.format('all', '', tmpdir))
+        assert 'from the collection cache' not in output, output
+        assert '= 2 passed in' in output, output
+        assert len(self.redis.keys('collection:*')) == 2
+
+    def test_collection_cache_missing_test(self, tmpdir):
+        tmpdir.join('test_env.py').write(
+            "import os\n"
+            "import pytest\n\n\n"
+            "@pytest.mark.parametrize('name', [os.environ['CIQUEUE_PARAM']])\n"
+            "def test_env(name):\n"
+            "    pass\n")
+        cmd = ("CIQUEUE_PARAM={} py.test -p ciqueue.pytest "
+               "--queue 'redis://localhost:6379/0?worker=0&build={}&timeout=5&collection_cache_key=collection' {}; "
+               "exit 0")
+        assert '= 1 passed in' in check_output(cmd.format('a', 'cold', tmpdir))
+
+        # The cache still has test_env[a], which the file now collects as test_env[b]
+        output = check_output(cmd.format('b', 'warm', tmpdir))
+        assert 'from the collection cache' in output, output
+        assert "test_env.py::test_env[a] is in the collection cache, but its file doesn't collect it" in output, output
+        assert '= 1 failed in' in output, output
+        assert not self.redis.zcard('build:{warm}:running')
+        assert self.redis.scard('build:{warm}:processed') == 1
+
+    def test_procs(self, tmpdir):
+        queue = ('redis://localhost:6379/0?worker=0&build=procs&timeout=5&procs=3'
+                 '&max_requeues=1&requeue_tolerance=0.2')
+        xml_file = os.path.join(tmpdir.strpath, 'test.xml')
+        cmd = "py.test -v -r a -p ciqueue.pytest --queue '{}' --junit-xml='{}' integrations/pytest/test_all.py; exit 0"\
+            .format(queue, xml_file)
+        report_cmd = "py.test -v -r a -p ciqueue.pytest_report --queue '{}' integrations/pytest/test_all.py; exit 0"\
+            .format(queue)
+
+        output = check_output(cmd)
+        assert re.search(r'= 4 failed, 2 passed, 4 skipped, 1 xpassed, (1 warning, )?6 errors in', output), output
+        assert 'ciqueue stats' in output, output
+        assert self.redis.smembers('build:{procs}:workers') == {b'0.0', b'0.1', b'0.2'}
+
+        # The retried tests only reach the parent as skips
+        xml = open(xml_file).read()
+        assert xml.count('/failure') == 4
+        assert xml.count('/skipped') == 4
+        assert xml.count('/error') == 6
+
+        expected_messages(check_output(report_cmd))
+
+    def test_retry_failed(self):
+        queue = "redis://localhost:6379/0?worker=0&build=foo&timeout=5"
+        cmd = "py.test -v -r a -p ciqueue.pytest --queue '{}' integrations/pytest/test_all.py {}; exit 0"
+        expected_messages(check_output(cmd.format(queue, '')))
+
+        # The report drops the worker's list of tests, but not its failures
+        report_cmd = "py.test -v -r a -p ciqueue.pytest_report --queue '{}' --queue-compact {}; exit 0"
+        expected_messages(check_output(report_cmd.format(queue, 'integrations/pytest/test_all.py')))
+        assert not self.redis.exists('build:{foo}:worker:0:queue')
+
+        # Only the failing tests run again, test_fixtures.py isn't even collected
+        output = check_output(cmd.format(queue + '&retry=failed', 'integrations/pytest/test_fixtures.py'))
+        assert 'collected 9 failed items to retry' in output, output
+        assert re.search(r'= 4 failed, 1 passed, (1 warning, )?6 errors in', output), output
+        assert 'test_fixtures.py' not in output, output
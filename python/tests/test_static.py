@@ -7,3 +7,9 @@ class TestStatic(shared.QueueImplementation):
     def build_queue(self, **kwargs):
         return ciqueue.Static(list(self.TEST_LIST), max_requeues=1,
                               requeue_tolerance=0.1)
+
+    def test_requeue_tolerance(self):
+        queue = ciqueue.Static(['test_{}'.format(i) for i in range(20)], max_requeues=1, requeue_tolerance=0.1)
+        requeued = [test for test in queue if queue.requeue(test)]
+        assert requeued == ['test_0', 'test_1']
+        assert queue.requeue_count == 2
@@ -0,0 +1,32 @@
+from ciqueue import stats
+
+
+class TestStats:
+    def test_histogram(self):
+        histogram = stats.Histogram()
+        for seconds in (0.001, 0.001, 0.002, 0.5):
+            histogram.add(seconds)
+        assert histogram.count == 4
+        assert histogram.maximum == 0.5
+        # 1ms lands in the bucket up to 1024us
+        assert histogram.percentile(50) == 1024 / 1e6
+        assert histogram.percentile(100) == 0.5
+
+    def test_merge_and_serialize(self):
+        first = stats.Stats()
+        first.timings['script:reserve'].add(0.001)
+        first.incr('reserved')
+        second = stats.Stats()
+        second.timings['script:reserve'].add(0.003)
+        second.timings['idle'].add(1)
+        second.incr('reserved', 2)
+
+        merged = stats.Stats.loads(first.dumps())
+        merged.merge(stats.Stats.loads(second.dumps()))
+        assert merged.timings['script:reserve'].count == 2
+        assert merged.timings['script:reserve'].maximum == 0.003
+        assert merged.counters == {'reserved': 3}
+
+        lines = merged.summary()
+        assert lines[1].split()[:3] == ['idle', '1', '1.00s']
+        assert lines[-1] == 'reserved: 3'
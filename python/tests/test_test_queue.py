@@ -1,3 +1,5 @@
+import os
+import redis
 import ciqueue.distributed
 from ciqueue._pytest import test_queue
 
@@ -12,3 +14,21 @@ class TestTestQueue:
         queue = test_queue.build_queue('rediss://localhost:6379/0?worker=1&build=12345', None)
         assert isinstance(queue, ciqueue.distributed.Supervisor)
         assert queue.redis is not None
+
+    def test_parse_batch_size(self):
+        args = test_queue.parse_worker_args('worker=1&build=12345&batch_size=10', {})
+        assert args['options'].batch_size == 10
+
+        args = test_queue.parse_worker_args('worker=1&build=12345', {})
+        assert args['options'].batch_size == 1
+
+    def test_failed_tests_only_reads_the_build(self):
+        client = redis.StrictRedis(host=os.getenv('REDIS_HOST'))
+        client.flushdb()
+        client.sadd('build:{12345}:worker:1.0:failed', 'a.py::test_b')
+        client.sadd('build:{12345}:worker:1.1:failed', 'a.py::test_a')
+
+        url = 'redis://localhost:6379/0?worker=1&build=12345&retry=failed&procs=2'
+        assert test_queue.failed_tests(url) == ['a.py::test_b', 'a.py::test_a']
+        # An expired build isn't started again, and the worker isn't registered
+        assert sorted(client.keys()) == [b'build:{12345}:worker:1.0:failed', b'build:{12345}:worker:1.1:failed']
@@ -0,0 +1,51 @@
+-- Requeued tests used to be inserted `offset` positions from the head of the
+-- queue with LINSERT, which is O(N) and ambiguous when a test is listed twice.
+-- When the caller passes `deferred_key` and `pops_key` they go in a sorted set
+-- instead, scored with the number of tests that must be popped before them.
+-- Expects `queue_key`, `deferred_key` and `pops_key` to be defined.
+
+local function defer(test, offset)
+  local pops = tonumber(redis.call('get', pops_key)) or 0
+  redis.call('zadd', deferred_key, pops + tonumber(offset) + 1, test)
+end
+
+-- Returns the next test, and its score when it was deferred
+local function pop()
+  if not deferred_key then
+    return redis.call('rpop', queue_key)
+  end
+
+  local test = nil
+  local score = nil
+  local next_deferred = redis.call('zrange', deferred_key, 0, 0, 'WITHSCORES')
+  local pops = tonumber(redis.call('get', pops_key)) or 0
+  if next_deferred[1] and tonumber(next_deferred[2]) <= pops then
+    test, score = next_deferred[1], next_deferred[2]
+  else
+    test = redis.call('rpop', queue_key)
+    if not test then
+      test, score = next_deferred[1], next_deferred[2]
+    end
+  end
+
+  if test then
+    redis.call('zrem', deferred_key, test)
+    redis.call('incr', pops_key)
+  end
+  return test, score
+end
+
+-- Puts back the test `pop` returned, where it was
+local function unpop(test, score)
+  if not deferred_key then
+    redis.call('rpush', queue_key, test)
+    return
+  end
+
+  if score then
+    redis.call('zadd', deferred_key, score, test)
+  else
+    redis.call('rpush', queue_key, test)
+  end
+  redis.call('decr', pops_key)
+end
@@ -0,0 +1,9 @@
+-- Idle workers block on the build's events channel instead of polling the
+-- queue, these wake them up. Callers that don't pass `events_key` publish
+-- nothing, their peers still notice the change within a few seconds.
+
+local function notify(event)
+  if events_key then
+    redis.call('publish', events_key, event)
+  end
+end
@@ -0,0 +1,32 @@
+-- Reclaims the oldest test of the running set whose lease expired, i.e. that
+-- has been running for longer than `timeout`, and returns its {test, lease}.
+-- Stale entries of tests already processed by another worker are cleaned up
+-- on the way. Expects the keys of reserve_lost.lua, under the same names.
+
+-- Only look at the oldest entries, stale ones past them are cleaned up by later calls
+-- rather than blocking Redis on builds with a large running set.
+local max_lost_tests = 100
+
+local function reserve_lost_test(current_time, timeout)
+  local lost_tests = redis.call('zrangebyscore', zset_key, 0, current_time - timeout, 'LIMIT', 0, max_lost_tests)
+  for _, test in ipairs(lost_tests) do
+    remove_owned_test(redis.call('hget', owners_key, test), test)
+    if redis.call('sismember', processed_key, test) == 0 then
+      local lease = redis.call('incr', lease_counter_key)
+      redis.call('zadd', zset_key, running_score(test, current_time), test)
+      redis.call('lpush', worker_queue_key, test)
+      redis.call('hset', owners_key, test, worker_queue_key)
+      redis.call('hset', leases_key, test, lease)
+      add_owned_test(worker_queue_key, test)
+      return {test, tostring(lease)}
+    else
+      -- Test is already processed but still in running (stale). This can happen when
+      -- a non-owner worker acknowledged the test (marking it processed) but could not
+      -- remove it from running due to the lease guard. Clean it up.
+      redis.call('zrem', zset_key, test)
+      redis.call('hdel', owners_key, test)
+      redis.call('hdel', leases_key, test)
+    end
+  end
+  return nil
+end
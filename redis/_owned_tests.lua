@@ -0,0 +1,16 @@
+-- Each worker keeps the set of tests it owns next to its queue log, e.g.
+-- build:1:worker:2:queue -> build:1:worker:2:owned, so it can find its own
+-- tests without scanning the owners hash of the whole build.
+local function owned_tests_key(worker_queue_key)
+  return (string.gsub(worker_queue_key, 'queue$', 'owned'))
+end
+
+local function add_owned_test(worker_queue_key, test)
+  redis.call('sadd', owned_tests_key(worker_queue_key), test)
+end
+
+local function remove_owned_test(worker_queue_key, test)
+  if worker_queue_key then
+    redis.call('srem', owned_tests_key(worker_queue_key), test)
+  end
+end
@@ -0,0 +1,15 @@
+-- Tests with a duration history get their own timeout. The leader stores in
+-- `timeout_offsets_key` how many seconds it differs from the global timeout,
+-- and it's added to the test's score in the running set, which reserve_lost
+-- compares with `current_time - timeout`. Callers that don't pass the key
+-- keep the global timeout for every test.
+
+local function running_score(test, current_time)
+  if timeout_offsets_key then
+    local offset = tonumber(redis.call('hget', timeout_offsets_key, test))
+    if offset then
+      return tonumber(current_time) + offset
+    end
+  end
+  return current_time
+end
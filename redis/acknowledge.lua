@@ -4,11 +4,22 @@ local owners_key = KEYS[3]
 local error_reports_key = KEYS[4]
 local requeued_by_key = KEYS[5]
 local leases_key = KEYS[6]
+-- Optional, see _events.lua
+local events_key = KEYS[7]
+-- Optional, the set of the tests this worker failed. Failures are the errors
+-- acknowledged without `always_record`, only their first run is recorded.
+local failed_key = KEYS[8]
 
 local entry = ARGV[1]
 local error = ARGV[2]
 local ttl = ARGV[3]
 local lease_id = ARGV[4]
+-- When set, the error report is written (or cleared if `error` is empty) even if
+-- another worker already acknowledged the entry, so the last run wins.
+local always_record = ARGV[5] == '1'
+
+-- @include _owned_tests
+-- @include _events
 
 -- Only the current lease holder can remove the entry from the running set.
 -- If the lease was transferred (e.g. via reserve_lost), the stale worker
@@ -16,16 +27,31 @@ local lease_id = ARGV[4]
 -- the queue is exhausted while the new lease holder is still processing.
 if tostring(redis.call('hget', leases_key, entry)) == lease_id then
   redis.call('zrem', zset_key, entry)
+  remove_owned_test(redis.call('hget', owners_key, entry), entry)
   redis.call('hdel', owners_key, entry)
   redis.call('hdel', leases_key, entry)
+  -- The supervisor and idle workers are waiting for the last running test
+  if redis.call('zcard', zset_key) == 0 then
+    notify('drained')
+  end
 end
 
 redis.call('hdel', requeued_by_key, entry)
 local acknowledged = redis.call('sadd', processed_key, entry) == 1
 
-if acknowledged and error ~= "" then
-  redis.call('hset', error_reports_key, entry, error)
-  redis.call('expire', error_reports_key, ttl)
+if acknowledged or always_record then
+  if error ~= "" then
+    redis.call('hset', error_reports_key, entry, error)
+    if (tonumber(ttl) or 0) > 0 then
+      redis.call('expire', error_reports_key, ttl)
+    end
+  elseif always_record then
+    redis.call('hdel', error_reports_key, entry)
+  end
+end
+
+if failed_key and acknowledged and error ~= "" and not always_record then
+  redis.call('sadd', failed_key, entry)
 end
 
 return acknowledged
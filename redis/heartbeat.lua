@@ -1,10 +1,14 @@
 local zset_key = KEYS[1]
 local leases_key = KEYS[2]
+-- Optional, see _timeouts.lua
+local timeout_offsets_key = KEYS[3]
 
 local current_time = ARGV[1]
 local entry = ARGV[2]
 local lease_id = ARGV[3]
 
+-- @include _timeouts
+
 -- Only the current lease holder can bump the timestamp.
 -- We intentionally do NOT check the processed set. A non-owner worker's
 -- acknowledge can add the entry to processed, which would poison the
@@ -12,5 +16,5 @@ local lease_id = ARGV[3]
 -- The lease check alone is sufficient — once the lease holder acknowledges,
 -- they zrem + hdel the lease, so the heartbeat will naturally stop.
 if tostring(redis.call('hget', leases_key, entry)) == lease_id then
-  return redis.call('zadd', zset_key, current_time, entry)
+  return redis.call('zadd', zset_key, running_score(entry, current_time), entry)
 end
@@ -2,16 +2,23 @@ local zset_key = KEYS[1]
 local worker_queue_key = KEYS[2]
 local owners_key = KEYS[3]
 local leases_key = KEYS[4]
+-- Optional, see _events.lua
+local events_key = KEYS[5]
 
--- owned_tests = {"SomeTest", "worker:1", "SomeOtherTest", "worker:2", ...}
-local owned_tests = redis.call('hgetall', owners_key)
-for index, owner_or_test in ipairs(owned_tests) do
-  if owner_or_test == worker_queue_key then -- If we owned a test
-    local test = owned_tests[index - 1]
+-- @include _owned_tests
+-- @include _events
+
+local released = false
+for _, test in ipairs(redis.call('smembers', owned_tests_key(worker_queue_key))) do
+  if redis.call('hget', owners_key, test) == worker_queue_key then -- If we still own the test
     redis.call('zadd', zset_key, "0", test) -- We expire the lease immediately
     redis.call('hdel', leases_key, test)
-    return nil
+    released = true
   end
 end
 
+if released then
+  notify('release')
+end
+
 return nil
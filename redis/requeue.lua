@@ -7,6 +7,11 @@ local owners_key = KEYS[6]
 local error_reports_key = KEYS[7]
 local requeued_by_key = KEYS[8]
 local leases_key = KEYS[9]
+-- Optional, see _deferred_queue.lua
+local deferred_key = KEYS[10]
+local pops_key = KEYS[11]
+-- Optional, see _events.lua
+local events_key = KEYS[12]
 
 local max_requeues = tonumber(ARGV[1])
 local global_max_requeues = tonumber(ARGV[2])
@@ -15,6 +20,10 @@ local offset = ARGV[4]
 local ttl = tonumber(ARGV[5])
 local lease_id = ARGV[6]
 
+-- @include _owned_tests
+-- @include _deferred_queue
+-- @include _events
+
 -- Only the current lease holder can requeue a test.
 -- If the lease was transferred (e.g. via reserve_lost), reject the stale
 -- worker's requeue so the running entry stays intact for the new holder.
@@ -41,11 +50,15 @@ redis.call('hincrby', requeues_count_key, entry, 1)
 
 redis.call('hdel', error_reports_key, entry)
 
-local pivot = redis.call('lrange', queue_key, -1 - offset, 0 - offset)[1]
-if pivot then
-  redis.call('linsert', queue_key, 'BEFORE', pivot, entry)
+if deferred_key then
+  defer(entry, offset)
 else
-  redis.call('lpush', queue_key, entry)
+  local pivot = redis.call('lrange', queue_key, -1 - offset, 0 - offset)[1]
+  if pivot then
+    redis.call('linsert', queue_key, 'BEFORE', pivot, entry)
+  else
+    redis.call('lpush', queue_key, entry)
+  end
 end
 
 redis.call('hset', requeued_by_key, entry, worker_queue_key)
@@ -53,8 +66,10 @@ if ttl and ttl > 0 then
   redis.call('expire', requeued_by_key, ttl)
 end
 
+remove_owned_test(redis.call('hget', owners_key, entry), entry)
 redis.call('hdel', owners_key, entry)
 redis.call('hdel', leases_key, entry)
 redis.call('zrem', zset_key, entry)
+notify('requeue')
 
 return true
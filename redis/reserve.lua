@@ -7,12 +7,46 @@ local requeued_by_key = KEYS[6]
 local workers_key = KEYS[7]
 local leases_key = KEYS[8]
 local lease_counter_key = KEYS[9]
+-- Optional, see _deferred_queue.lua
+local deferred_key = KEYS[10]
+local pops_key = KEYS[11]
+-- Optional, maps each test to its module or class when the build groups them
+local groups_key = KEYS[12]
+-- Optional, see _timeouts.lua
+local timeout_offsets_key = KEYS[13]
 
 local current_time = ARGV[1]
 local defer_offset = tonumber(ARGV[2]) or 0
+-- 0 only reserves a lost test, when a timeout is given
+local batch_size = tonumber(ARGV[3]) or 1
+-- Optional, when given the tests whose lease expired are reclaimed before the
+-- queue is looked at, as reserve_lost.lua does, and the reply starts with the
+-- number of lost tests reclaimed: {1, "LostTest", "3"} or {0, "SomeTest", "4", ...}
+local timeout = tonumber(ARGV[4])
 local max_skip_attempts = 4
 
+-- @include _owned_tests
+-- @include _deferred_queue
+-- @include _timeouts
+-- @include _lost_tests
+
+if timeout then
+  local lost = reserve_lost_test(current_time, timeout)
+  if lost then
+    return {1, lost[1], lost[2]}
+  end
+end
+
+-- reserved = {"SomeTest", "1", "SomeOtherTest", "2", ...}
+-- With the default batch_size of 1 this is the same {test, lease} pair
+-- callers that don't pass a batch size expect.
+local reserved = {}
+
 local function insert_with_offset(test)
+  if deferred_key then
+    return defer(test, defer_offset)
+  end
+
   local pivot = redis.call('lrange', queue_key, -1 - defer_offset, 0 - defer_offset)[1]
   if pivot then
     redis.call('linsert', queue_key, 'BEFORE', pivot, test)
@@ -23,39 +57,80 @@ end
 
 local function claim_test(test)
   local lease = redis.call('incr', lease_counter_key)
-  redis.call('zadd', zset_key, current_time, test)
+  -- Only the first test runs right away, the ones buffered behind it keep
+  -- the global timeout so that a short one of their own doesn't expire
+  -- before the worker gets to them.
+  local score = current_time
+  if #reserved == 0 then
+    score = running_score(test, current_time)
+  end
+  redis.call('zadd', zset_key, score, test)
   redis.call('lpush', worker_queue_key, test)
   redis.call('hset', owners_key, test, worker_queue_key)
   redis.call('hset', leases_key, test, lease)
-  return {test, tostring(lease)}
+  add_owned_test(worker_queue_key, test)
+  table.insert(reserved, test)
+  table.insert(reserved, tostring(lease))
+end
+
+-- A worker doesn't take back a test it requeued, unless it's the build's only worker.
+local function requeued_by_self(test)
+  return redis.call('hget', requeued_by_key, test) == worker_queue_key and
+    redis.call('scard', workers_key) > 1
 end
 
-for attempt = 1, max_skip_attempts do
-  local test = redis.call('rpop', queue_key)
+local attempt = 0
+while #reserved < batch_size * 2 do
+  local test = pop()
   if not test then
-    return nil
+    break
   end
 
-  local requeued_by = redis.call('hget', requeued_by_key, test)
-  if requeued_by == worker_queue_key then
-    -- If this build only has one worker, allow immediate self-pickup.
-    if redis.call('scard', workers_key) <= 1 then
-      redis.call('hdel', requeued_by_key, test)
-      return claim_test(test)
-    end
-
+  if requeued_by_self(test) then
     insert_with_offset(test)
+    attempt = attempt + 1
 
-    -- If this worker only finds its own requeued tests, defer once by returning nil,
+    -- If this worker only finds its own requeued tests, defer once by stopping here,
     -- then allow pickup on a subsequent reserve attempt.
     if attempt == max_skip_attempts then
       redis.call('hdel', requeued_by_key, test)
-      return nil
+      break
     end
   else
     redis.call('hdel', requeued_by_key, test)
-    return claim_test(test)
+    claim_test(test)
+  end
+end
+
+if #reserved == 0 then
+  return nil
+end
+
+-- Keep reserving while the next tests belong to the same group as the last
+-- one we got, so the worker can reuse its scoped fixtures. A deferred test
+-- that is due, or one this worker requeued, ends the group's reservation.
+if groups_key then
+  local group = redis.call('hget', groups_key, reserved[#reserved - 1])
+  while group do
+    local test, score = pop()
+    if not test then
+      break
+    end
+    if redis.call('hget', groups_key, test) ~= group then
+      unpop(test, score)
+      break
+    end
+    if requeued_by_self(test) then
+      insert_with_offset(test)
+      break
+    end
+    redis.call('hdel', requeued_by_key, test)
+    claim_test(test)
   end
 end
 
-return nil
+if timeout then
+  table.insert(reserved, 1, 0)
+end
+
+return reserved
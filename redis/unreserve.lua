@@ -0,0 +1,36 @@
+local queue_key = KEYS[1]
+local zset_key = KEYS[2]
+local worker_queue_key = KEYS[3]
+local owners_key = KEYS[4]
+local leases_key = KEYS[5]
+-- Optional, see _events.lua
+local events_key = KEYS[6]
+
+-- @include _owned_tests
+-- @include _events
+
+-- ARGV = {"SomeTest", "1", "SomeOtherTest", "2", ...}, in the order the worker
+-- would have run them. We push them back to the tail of the queue in reverse
+-- so the next reserve pops them in that same order.
+local given_back = false
+for index = #ARGV - 1, 1, -2 do
+  local test = ARGV[index]
+  local lease_id = ARGV[index + 1]
+
+  -- Only give back tests we still hold; a lost lease belongs to someone else.
+  if tostring(redis.call('hget', leases_key, test)) == lease_id then
+    redis.call('zrem', zset_key, test)
+    redis.call('hdel', owners_key, test)
+    redis.call('hdel', leases_key, test)
+    remove_owned_test(worker_queue_key, test)
+    redis.call('lrem', worker_queue_key, 1, test)
+    redis.call('rpush', queue_key, test)
+    given_back = true
+  end
+end
+
+if given_back then
+  notify('unreserve')
+end
+
+return nil